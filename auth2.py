@@ -29,14 +29,15 @@ import hmac
 
 # For use with D2LAppContext and D2LUserContext
 try:
-    from urllib.parse import urlparse, urlencode, urlunsplit, parse_qs, unquote_plus, urlsplit
+    from urllib.parse import urlparse, urlencode, urlunsplit, parse_qs, unquote_plus, urlsplit, quote_plus
 except ImportError:
     from urlparse import urlparse, urlunsplit, parse_qs, urlsplit
-    from urllib import urlencode, unquote_plus
+    from urllib import urlencode, unquote_plus, quote_plus
 
 # For use with D2LUserContext
 import time
 import re
+from email.utils import parsedate_tz, mktime_tz
 from requests.auth import AuthBase
 
 
@@ -72,6 +73,29 @@ class D2LSigner(object):
     appropriately signed tokens.
     """
 
+    __slots__ = ('_keyed',)
+
+    # keyed HMAC objects kept per signer before the oldest are dropped
+    MAX_KEYS = 256
+
+    def __init__(self):
+        self._keyed = {}
+
+    def _keyed_hmac(self, key_string):
+        # HMAC state with the key already absorbed; copied for every digest
+        # so the key padding is only computed once per key
+        try:
+            keyed = self._keyed
+        except AttributeError:
+            keyed = self._keyed = {}
+        h = keyed.get(key_string)
+        if h is None:
+            if len(keyed) >= self.MAX_KEYS:
+                keyed.clear()
+            h = hmac.new(key_string.encode('utf-8'), digestmod=hashlib.sha256)
+            keyed[key_string] = h
+        return h
+
     def get_hash(self, key_string, base_string):
         """Get a digest value suitable for direct inclusion into an URL's
         query parameter as a token.
@@ -94,9 +118,8 @@ class D2LSigner(object):
         :returns: URL-safe, base64 encoded result of the signing operation
         suitable for adding to a server request.
         """
-        k, b = key_string.encode('utf-8'), base_string.encode('utf-8')
-
-        h256 = hmac.new(k, b, hashlib.sha256)
+        h256 = self._keyed_hmac(key_string).copy()
+        h256.update(base_string.encode('utf-8'))
         d = base64.urlsafe_b64encode(h256.digest())
         result = d.decode('utf-8').replace('=', '').strip()
 
@@ -121,6 +144,8 @@ class D2LAppContext(object):
     application.
     """
 
+    __slots__ = ('signer', 'app_id', 'app_key')
+
     # route for requesting a user token
     AUTH_API = '/d2l/auth/api/token'
 
@@ -309,6 +334,19 @@ class D2LUserContext(AuthBase):
     """Calling user context that a Valence Learning Framework API client
     application will use for all API calls.  """
 
+    # AuthBase does not declare __slots__, so instances still carry a
+    # __dict__; the slots keep attribute access off it for the hot fields.
+    __slots__ = ('signer', 'scheme', 'host', 'user_id', 'user_key', 'app_id',
+                 'app_key', 'encrypt_requests', 'server_skew', 'anonymous',
+                 '_token_memo', '_url_templates')
+
+    # compiled once for every context rather than per instance
+    invalid_path_chars = re.compile("[^a-zA-Z0-9-_~!&,;=:@.$*+()'/%]+")
+
+    # body of the 403 the service returns for a request signed too far from
+    # its clock, optionally followed by the service's time in seconds
+    timestamp_error = re.compile(r'Timestamp out of range\s*(\d+)?', re.I)
+
     # Constants for use by inheriting D2LUserContext classes, used to help keep
     # track of the query parameter names used in Valence API URLs.
     SCHEME_P = 'http'
@@ -374,7 +412,9 @@ class D2LUserContext(AuthBase):
         else:
             self.signer = signer
 
-        self.invalid_path_chars = re.compile("[^a-zA-Z0-9-_~!&,;=:@.$*+()'/%]+")
+        # signed tokens for the current second, and URL prefixes per route
+        self._token_memo = (None, {})
+        self._url_templates = {}
 
     # Entrypoint for use by requests.auth.AuthBase callers
     def __call__(self, r):
@@ -396,9 +436,19 @@ class D2LUserContext(AuthBase):
         return str(t)
 
     def _build_tokens_for_path(self, path, method='GET'):
+        time = self._get_time_string()
+        memo_time, memo = self._token_memo
+        if time != memo_time:
+            memo = {}
+            self._token_memo = (time, memo)
+        memo_key = (path, method, self.app_id, self.app_key, self.user_id,
+                    self.user_key)
+        tokens = memo.get(memo_key)
+        if tokens is not None:
+            return tokens
+
         if self.invalid_path_chars.search(path):
             raise ValueError("path contains invalid characters for URL path")
-        time = self._get_time_string()
         bs_path = unquote_plus(path.lower())
         base = '{0}&{1}&{2}'.format(method.upper(), bs_path, time)
 
@@ -409,11 +459,19 @@ class D2LUserContext(AuthBase):
             user_sig = self.signer.get_hash(self.user_key, base)
 
         # return dictionary containing the auth token parameters
-        return {self.APP_ID: [self.app_id],
-                self.APP_SIG: [app_sig],
-                self.USER_ID: [self.user_id],
-                self.USER_SIG: [user_sig],
-                self.TIME: [time]}
+        tokens = {self.APP_ID: [self.app_id],
+                  self.APP_SIG: [app_sig],
+                  self.USER_ID: [self.user_id],
+                  self.USER_SIG: [user_sig],
+                  self.TIME: [time]}
+        memo[memo_key] = tokens
+        return tokens
+
+    def _encode_tokens(self, tokens):
+        # same bytes as urlencode(tokens, doseq=True) for the single-valued
+        # token dictionary, in the dictionary's own order
+        return '&'.join(quote_plus(key) + '=' + quote_plus(str(value[0]))
+                        for key, value in tokens.items())
 
     def decorate_url_with_authentication(self,
                                          url,
@@ -429,16 +487,32 @@ class D2LUserContext(AuthBase):
         time-limited authentication token parameters needed for a Valence API
         call.
         """
-        scheme = netloc = path = query = fragment = ''
-
-        parts = urlsplit(url)
-        scheme, netloc, path, query, fragment = parts[:5]
-        qparms_dict = parse_qs(query)
-
-        qparms_dict.update(self._build_tokens_for_path(path, method=method))
-        query = urlencode(qparms_dict, doseq=True)
-
-        return urlunsplit((scheme, netloc, path, query, fragment))
+        template = self._url_templates.get(url)
+        if template is None:
+            parts = urlsplit(url)
+            scheme, netloc, path, query, fragment = parts[:5]
+            if query or fragment:
+                qparms_dict = parse_qs(query)
+                qparms_dict.update(self._build_tokens_for_path(path,
+                                                               method=method))
+                query = urlencode(qparms_dict, doseq=True)
+                return urlunsplit((scheme, netloc, path, query, fragment))
+            prefix = urlunsplit((scheme, netloc, path, '', '')) + '?'
+            template = self._remember_template(url, (prefix, path))
+
+        prefix, path = template
+        # the reference merged the tokens into parse_qs('') before encoding;
+        # on Python 2 that dictionary can iterate in a different order from
+        # the token dictionary itself, so merge the same way
+        tokens = {}
+        tokens.update(self._build_tokens_for_path(path, method=method))
+        return prefix + self._encode_tokens(tokens)
+
+    def _remember_template(self, key, template):
+        if len(self._url_templates) >= 512:
+            self._url_templates.clear()
+        self._url_templates[key] = template
+        return template
     
     def create_authenticated_url(self,
                                  api_route='/d2l/api/versions/',
@@ -454,20 +528,19 @@ class D2LUserContext(AuthBase):
         the time-limited authentication token parameters needed for a Valence
         API call.
         """
-        # the urlunsplit parts needed to build an URL
-        scheme = netloc = path = query = fragment = ''
-        scheme = self.SCHEME_P
-        if self.encrypt_requests:
-            scheme = self.SCHEME_S
-        netloc = self.host
-        path = api_route
-
-        query = urlencode(self._build_tokens_for_path(
-                                             path,
-                                             method=method),
-                                       doseq=True)
-
-        return urlunsplit((scheme, netloc, path, query, fragment))
+        # the URL up to the query only depends on the route, so it is built
+        # once per route and the token parameters are spliced onto it
+        template_key = (api_route, self.encrypt_requests, self.host)
+        prefix = self._url_templates.get(template_key)
+        if prefix is None:
+            scheme = self.SCHEME_P
+            if self.encrypt_requests:
+                scheme = self.SCHEME_S
+            prefix = urlunsplit((scheme, self.host, api_route, '', '')) + '?'
+            self._remember_template(template_key, prefix)
+
+        return prefix + self._encode_tokens(
+            self._build_tokens_for_path(api_route, method=method))
 
     # Currently, this function does very little, and is present mostly for
     # symmetry with the other Valence client library packages.
@@ -495,11 +568,38 @@ class D2LUserContext(AuthBase):
         elif result_code == 401:
             result = D2LAuthResult.INVALID_SIG
         elif result_code == 403:
-            # Might also be timestamp issues here?
-            result = D2LAuthResult.NO_PERMISSION
+            server_time = self._server_time(response)
+            if server_time is None:
+                result = D2LAuthResult.NO_PERMISSION
+            else:
+                # re-sync with the service's clock so a retry is accepted
+                skew = int(round((server_time - time.time()) * 1000))
+                self.set_new_skew(skew)
+                if logfile:
+                    logfile.write('Timestamp out of range; server skew now '
+                                  '{0} ms\n'.format(skew))
+                result = D2LAuthResult.INVALID_TIMESTAMP
 
         return result
 
+    def _server_time(self, response):
+        # the service's clock from a timestamp 403, in seconds: the time in
+        # the body if given, else the response's Date header; None for
+        # other 403s
+        text = getattr(response, 'text', response) or ''
+        if isinstance(text, bytes):
+            text = text.decode('utf-8', 'replace')
+        match = self.timestamp_error.search(text)
+        if match is None:
+            return None
+        if match.group(1):
+            return int(match.group(1))
+        headers = getattr(response, 'headers', None) or {}
+        date = parsedate_tz(headers.get('Date', ''))
+        if date is None:
+            return None
+        return mktime_tz(date)
+
     def get_context_properties(self):
         """Retrieve a dictionary of this calling user context's current state,
         suitable for rebuilding this user context at a later time.
@@ -519,3 +619,4 @@ class D2LUserContext(AuthBase):
         :param newSkewMillis: New server time-skew value, in milliseconds.
         """
         self.server_skew = new_skew
+        self._token_memo = (None, {})
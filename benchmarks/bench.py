@@ -0,0 +1,166 @@
+# enrollments/benchmarks/bench.py
+#
+# Times the app's hot paths against the stub Valence server, fully offline.
+#
+#     python benchmarks/bench.py [--output results.json] [--compare old.json]
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, HERE)
+
+from settings import write_settings
+from stub_valence import StubValence, course_code
+
+
+##########
+# timing #
+##########
+
+
+def measure(fn, repeat=5, min_time=0.2):
+    '''
+    Times fn, calling it enough times per repeat to run for min_time, and
+    returns the best and mean seconds per call.
+    '''
+    number = 1
+    while True:
+        start = time.time()
+        for i in range(number):
+            fn()
+        elapsed = time.time() - start
+        if elapsed >= min_time or number >= 1 << 20:
+            break
+        number *= 2 if elapsed == 0 else max(2, int(min_time / elapsed) + 1)
+    runs = [elapsed / number]
+    for i in range(repeat - 1):
+        start = time.time()
+        for j in range(number):
+            fn()
+        runs.append((time.time() - start) / number)
+    return {'best': min(runs), 'mean': sum(runs) / len(runs), 'number': number,
+            'repeat': repeat}
+
+
+##########
+# suites #
+##########
+
+
+def run(sizes, latency, min_time):
+    import views
+    import auth2 as d2lauth
+    from courses import CourseIndex, parse_code, parse_codes
+    from form import SelectCoursesForm, AdditionalCourseForm, BulkCourseForm
+
+    app = views.create_app(debug=True)
+    results = {}
+
+    def record(name, fn, **params):
+        result = measure(fn, min_time=min_time)
+        result['params'] = params
+        results[name] = result
+        print('{0:<40}{1:>12.1f} us'.format(name, result['best'] * 1e6))
+
+    signer = d2lauth.D2LSigner()
+    base = 'GET&/d2l/api/lp/1.4/users/whoami&{0}'.format(int(time.time()))
+    record('signer.get_hash', lambda: signer.get_hash('bench-key', base))
+
+    uc = views.appContext.create_user_context(d2l_user_context_props_dict={
+        'host': app.config['LMS_HOST'], 'user_id': 'bench-user',
+        'user_key': 'bench-key', 'encrypt_requests': False, 'server_skew': 0})
+    route = '/d2l/api/lp/1.4/enrollments/users/1/orgUnits/'
+    record('user_context.create_authenticated_url',
+           lambda: uc.create_authenticated_url(route))
+
+    code = course_code(7)
+    record('parse_code', lambda: parse_code(code))
+    page = [course_code(n) for n in range(100)]
+    record('parse_codes[100]', lambda: parse_codes(page), codes=len(page))
+
+    stub.latency = latency
+    for size in sizes:
+        stub.enrollments = size
+        record('get_courses[{0}]'.format(size),
+               lambda: views.get_courses(uc, '1'), enrollments=size,
+               page_size=stub.page_size, latency=latency)
+    stub.latency = 0
+
+    for size in sizes:
+        index = CourseIndex()
+        for n in range(size):
+            index.add('1145', 100000 + n, 'Stub Course {0}'.format(n),
+                      course_code(n))
+        courses = index.semester('1145')
+        record('get_courseId_choices[{0}]'.format(size),
+               lambda: views.get_courseId_choices(courses), courses=size)
+        with app.test_request_context():
+            record('get_baseCourse_choices[{0}]'.format(size),
+                   lambda: views.get_baseCourse_choices(courses), courses=size)
+
+            def render(cached):
+                if not cached:
+                    views.renderCache.clear()
+                form = SelectCoursesForm(prefix="form")
+                views.set_course_choices(form, index, '1145')
+                return views.render_template("enrollments.html", form=form,
+                    add_form=AdditionalCourseForm(prefix="add_form"),
+                    bulk_form=BulkCourseForm(prefix="bulk_form"), error=None)
+            record('render enrollments.html[{0}]'.format(size),
+                   lambda: render(False), courses=size)
+            record('render enrollments.html cached[{0}]'.format(size),
+                   lambda: render(True), courses=size)
+    return results
+
+
+def compare(results, previous):
+    print('\n{0:<40}{1:>12}{2:>12}{3:>9}'.format('', 'before us', 'after us', 'x'))
+    for name, result in sorted(results.items()):
+        if name in previous:
+            before, after = previous[name]['best'], result['best']
+            print('{0:<40}{1:>12.1f}{2:>12.1f}{3:>9.2f}'.format(
+                name, before * 1e6, after * 1e6, before / after))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', default='50,500,2000',
+        help='comma-separated enrollment counts (default 50,500,2000)')
+    parser.add_argument('--latency', type=float, default=0.0,
+        help='seconds the stub waits before each reply (default 0)')
+    parser.add_argument('--min-time', type=float, default=0.2,
+        help='minimum seconds per timing repeat (default 0.2)')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='enrollments-bench-')
+    stub = StubValence().start()
+    try:
+        write_settings(workdir, stub.host)
+        results = run([int(size) for size in args.sizes.split(',')],
+                      args.latency, args.min_time)
+    finally:
+        stub.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {'meta': {'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'sizes': args.sizes,
+                       'latency': args.latency},
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
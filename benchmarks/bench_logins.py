@@ -0,0 +1,102 @@
+# enrollments/benchmarks/bench_logins.py
+#
+# Runs many instructors' login calls - whoami, every enrollment page and an
+# orgstructure lookup - through valence.AsyncValence against the stub
+# Valence server, checks what comes back and reports logins per second for
+# each pool size.
+#
+#     python benchmarks/bench_logins.py [--logins 50] [--workers 1,8,32] \
+#         [--enrollments 300] [--latency 0.02]
+
+import argparse
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, HERE)
+
+import auth2 as d2lauth
+import valence
+from stub_valence import StubValence, course_code
+
+
+VER = '1.4'
+
+
+def user_context(host, userId):
+    ac = d2lauth.fashion_app_context(app_id='stub-app-id',
+                                     app_key='stub-app-key')
+    return ac.create_user_context(d2l_user_context_props_dict={
+        'host': host,
+        'user_id': userId,
+        'user_key': 'stub-user-key',
+        'encrypt_requests': False,
+        'server_skew': 0})
+
+
+def count_records(pages):
+    return sum(len(page) for page in pages)
+
+
+def logins(workers, userIds, stub):
+    '''
+    Runs every user's login calls on a pool of workers, overlapping users,
+    and returns the seconds taken. Raises AssertionError on a wrong result.
+    '''
+    client = valence.ValenceClient(stub.host, encrypt_requests=False,
+                                   pool_size=workers)
+    pool = valence.AsyncValence(client, VER, max_workers=workers)
+    try:
+        contexts = dict((userId, user_context(stub.host, userId))
+                        for userId in userIds)
+        start = time.time()
+        whoamis = dict((userId, pool.whoami(contexts[userId]))
+                       for userId in userIds)
+        enrollments = {}
+        lookups = {}
+        for userId in userIds:
+            whoami = whoamis[userId].result()
+            assert whoami['Identifier'] == userId, whoami
+            enrollments[userId] = pool.enrollments(contexts[userId],
+                whoami['Identifier'], count_records, roleId='914',
+                orgUnitTypeId='3')
+            lookups[userId] = pool.orgstructure(contexts[userId],
+                course_code(int(userId), stub.semCode), '3')
+        for userId in userIds:
+            count = enrollments[userId].result()
+            assert count == stub.enrollment_count(userId), (userId, count)
+            orgUnit = lookups[userId].result()
+            assert orgUnit['Code'] == course_code(int(userId), stub.semCode), orgUnit
+        return time.time() - start
+    finally:
+        pool.shutdown()
+        client.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--logins', type=int, default=50,
+        help='instructors logging in (default 50)')
+    parser.add_argument('--workers', default='1,8,32',
+        help='pool sizes to compare (default 1,8,32)')
+    parser.add_argument('--enrollments', type=int, default=300,
+        help='enrollments per instructor (default 300)')
+    parser.add_argument('--page-size', type=int, default=100,
+        help='enrollments per stub page (default 100)')
+    parser.add_argument('--latency', type=float, default=0.02,
+        help='seconds the stub waits before each reply (default 0.02)')
+    args = parser.parse_args()
+
+    stub = StubValence(enrollments=args.enrollments, page_size=args.page_size,
+                       latency=args.latency).start()
+    try:
+        userIds = [str(n + 1) for n in range(args.logins)]
+        print('{0:>8}{1:>10}{2:>12}'.format('workers', 'seconds', 'logins/s'))
+        for workers in [int(w) for w in args.workers.split(',')]:
+            elapsed = logins(workers, userIds, stub)
+            print('{0:>8}{1:>10.2f}{2:>12.1f}'.format(workers, elapsed,
+                                                      len(userIds) / elapsed))
+    finally:
+        stub.stop()
@@ -0,0 +1,159 @@
+# enrollments/benchmarks/bench_signing.py
+#
+# Compares Valence request signing before and after the auth2 fast path.
+#
+#     python benchmarks/bench_signing.py [seconds-per-case]
+
+import base64
+import hashlib
+import hmac
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import auth2 as d2lauth
+from auth2 import urlsplit, urlunsplit, urlencode, parse_qs, unquote_plus
+
+
+#############
+# reference #
+#############
+
+
+class ReferenceSigner(d2lauth.D2LSigner):
+    '''
+    D2LSigner.get_hash as it was before the keyed-HMAC fast path.
+    '''
+
+    def get_hash(self, key_string, base_string):
+        k, b = key_string.encode('utf-8'), base_string.encode('utf-8')
+        h256 = hmac.new(k, b, hashlib.sha256)
+        d = base64.urlsafe_b64encode(h256.digest())
+        return d.decode('utf-8').replace('=', '').strip()
+
+
+def reference_tokens(uc, path, method='GET'):
+    if uc.invalid_path_chars.search(path):
+        raise ValueError("path contains invalid characters for URL path")
+    t = uc._get_time_string()
+    base = '{0}&{1}&{2}'.format(method.upper(), unquote_plus(path.lower()), t)
+    app_sig = uc.signer.get_hash(uc.app_key, base)
+    user_sig = '' if uc.anonymous else uc.signer.get_hash(uc.user_key, base)
+    return {uc.APP_ID: [uc.app_id],
+            uc.APP_SIG: [app_sig],
+            uc.USER_ID: [uc.user_id],
+            uc.USER_SIG: [user_sig],
+            uc.TIME: [t]}
+
+
+def reference_authenticated_url(uc, api_route, method='GET'):
+    scheme = uc.SCHEME_S if uc.encrypt_requests else uc.SCHEME_P
+    query = urlencode(reference_tokens(uc, api_route, method), doseq=True)
+    return urlunsplit((scheme, uc.host, api_route, query, ''))
+
+
+def reference_decorate(uc, url, method='GET'):
+    scheme, netloc, path, query, fragment = urlsplit(url)[:5]
+    qparms_dict = parse_qs(query)
+    qparms_dict.update(reference_tokens(uc, path, method))
+    query = urlencode(qparms_dict, doseq=True)
+    return urlunsplit((scheme, netloc, path, query, fragment))
+
+
+#########
+# bench #
+#########
+
+
+def rate(fn, seconds):
+    '''
+    Calls fn repeatedly for about `seconds` and returns calls per second.
+    '''
+    calls = 0
+    start = time.time()
+    deadline = start + seconds
+    while time.time() < deadline:
+        for i in range(1000):
+            fn()
+        calls += 1000
+    return calls / (time.time() - start)
+
+
+def user_context(signer):
+    ac = d2lauth.D2LAppContext(app_id='bench-app-id',
+                               app_key='bench-app-key-0123456789',
+                               signer=signer)
+    return ac.create_user_context(d2l_user_context_props_dict={
+        'host': 'lms.example.edu',
+        'user_id': 'bench-user-id',
+        'user_key': 'bench-user-key-0123456789',
+        'encrypt_requests': True,
+        'server_skew': 0})
+
+
+def main(seconds=2.0):
+    route = '/d2l/api/lp/1.4/enrollments/users/12345/orgUnits/'
+    url = 'https://lms.example.edu' + route
+    base = 'GET&{0}&{1}'.format(route, int(time.time()))
+    old_signer, new_signer = ReferenceSigner(), d2lauth.D2LSigner()
+    old_uc, new_uc = user_context(old_signer), user_context(new_signer)
+
+    # the fast path must produce exactly the same bytes
+    assert (old_signer.get_hash('bench-app-key', base) ==
+            new_signer.get_hash('bench-app-key', base))
+    # several routes, as dictionary order on Python 2 depends on the values
+    routes = [route, '/d2l/api/lp/1.4/users/whoami',
+              '/d2l/api/lp/1.4/orgstructure/', '/d2l/api/versions/',
+              '/d2l/api/lp/1.4/enrollments/orgUnits/6606/users/']
+    while True:
+        t = new_uc._get_time_string()
+        same = True
+        for r in routes:
+            u = 'https://lms.example.edu' + r
+            same = same and (
+                reference_authenticated_url(old_uc, r) ==
+                new_uc.create_authenticated_url(r) and
+                reference_decorate(old_uc, u) ==
+                new_uc.decorate_url_with_authentication(u) and
+                reference_decorate(old_uc, u + '?bookmark=x') ==
+                new_uc.decorate_url_with_authentication(u + '?bookmark=x'))
+        if t == new_uc._get_time_string():
+            assert same, 'signed URLs differ from the reference'
+            break
+
+    def cold(fn):
+        # forgets the tokens signed this second, as for the first call on a
+        # route each second
+        def call():
+            new_uc._token_memo = (None, {})
+            return fn()
+        return call
+
+    cases = [
+        ('get_hash', lambda: old_signer.get_hash('bench-app-key', base),
+                     lambda: new_signer.get_hash('bench-app-key', base)),
+        ('create_authenticated_url',
+            lambda: reference_authenticated_url(old_uc, route),
+            lambda: new_uc.create_authenticated_url(route)),
+        ('decorate_url_with_authentication',
+            lambda: reference_decorate(old_uc, url),
+            lambda: new_uc.decorate_url_with_authentication(url)),
+        # the cases above mostly hit the per-second token memo; these sign
+        # every call
+        ('create_authenticated_url, cold',
+            lambda: reference_authenticated_url(old_uc, route),
+            cold(lambda: new_uc.create_authenticated_url(route))),
+        ('decorate_url_with_authentication, cold',
+            lambda: reference_decorate(old_uc, url),
+            cold(lambda: new_uc.decorate_url_with_authentication(url))),
+        ]
+    print('{0:<40}{1:>14}{2:>14}{3:>9}'.format('per second', 'before', 'after', 'x'))
+    for name, before, after in cases:
+        b, a = rate(before, seconds), rate(after, seconds)
+        print('{0:<40}{1:>14,.0f}{2:>14,.0f}{3:>9.1f}'.format(name, b, a, a / b))
+
+
+if __name__ == '__main__':
+    main(*[float(arg) for arg in sys.argv[1:2]])
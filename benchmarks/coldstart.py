@@ -0,0 +1,112 @@
+# enrollments/benchmarks/coldstart.py
+#
+# Times how long a fresh worker process takes to import the app, build it
+# and answer its first requests, against the stub Valence server.
+#
+#     python benchmarks/coldstart.py [--runs 10] [--output results.json]
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+sys.path.insert(0, HERE)
+
+from settings import write_settings
+from stub_valence import StubValence
+
+
+# run in each new process; prints the seconds spent in each phase as JSON
+CHILD = '''
+import json, sys, time
+start = time.time()
+phases = []
+def mark(name):
+    phases.append((name, time.time()))
+import flask, flask_mail, flask_wtf, jinja2, requests, werkzeug.test
+mark('libraries')
+import views
+mark('import views')
+app = views.create_app(debug=True)
+mark('create_app')
+client = app.test_client()
+client.get('/login')
+mark('first request')
+with client.session_transaction() as s:
+    s['userContext'] = {'host': app.config['LMS_HOST'], 'user_id': 'cold',
+                        'user_key': 'cold', 'encrypt_requests': False,
+                        'server_skew': 0}
+    s['userId'] = 'cold'
+client.post('/semester', data={'semester': 'Fall',
+    'year': str(time.localtime().tm_year - 1945)})
+mark('first valence request')
+last = start
+result = {}
+for name, at in phases:
+    result[name] = at - last
+    last = at
+result['total'] = last - start
+sys.stdout.write(json.dumps(result))
+'''
+
+
+def cold_start(env):
+    '''
+    Runs CHILD in a new interpreter and returns its phase timings.
+    '''
+    output = subprocess.check_output([sys.executable, '-W', 'ignore', '-c', CHILD], cwd=ROOT,
+                                     env=env)
+    return json.loads(output.decode('utf-8'))
+
+
+def summarize(runs):
+    names = [name for name in runs[0]]
+    summary = {}
+    for name in names:
+        values = sorted(run[name] for run in runs)
+        summary[name] = {'best': values[0],
+                         'median': values[len(values) // 2],
+                         'mean': sum(values) / len(values)}
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=10,
+        help='processes started (default 10)')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='enrollments-coldstart-')
+    stub = StubValence().start()
+    try:
+        write_settings(workdir, stub.host)
+        env = dict(os.environ)
+        # one run to write the compiled template cache, as a worker
+        # restarting on an existing install would find it
+        cold_start(env)
+        runs = [cold_start(env) for i in range(args.runs)]
+    finally:
+        stub.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    summary = summarize(runs)
+    print('{0:<24}{1:>10}{2:>10}{3:>10}'.format('', 'best ms', 'median ms',
+                                                 'mean ms'))
+    for name in list(runs[0]):
+        print('{0:<24}{1[best]:>10.1f}{1[median]:>10.1f}{1[mean]:>10.1f}'.format(
+            name, dict((k, v * 1000) for k, v in summary[name].items())))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'meta': {'python': platform.python_version(),
+                                'platform': platform.platform(),
+                                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                                'runs': args.runs},
+                       'results': summary}, f, indent=2, sort_keys=True)
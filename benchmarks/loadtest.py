@@ -0,0 +1,269 @@
+# enrollments/benchmarks/loadtest.py
+#
+# Drives many simulated instructors through login, semester choice, the
+# enrollments page, "Add Class", submission and confirmation, against the
+# real app served over HTTP and wired to a stub Valence server and a stub
+# SMTP sink, and reports throughput and latency percentiles per step.
+#
+#     python benchmarks/loadtest.py --flows 200 --concurrency 20 \
+#         --enrollments 20:0.5,100:0.4,1000:0.1 --latency 0.05
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, HERE)
+
+import requests
+from settings import write_settings
+from stub_smtp import StubSMTP
+from stub_valence import StubValence
+
+
+STEPS = ('login', 'token', 'semester', 'choose semester', 'enrollments',
+         'add class', 'submit', 'confirmation')
+
+
+###########
+# results #
+###########
+
+
+def percentile(values, p):
+    '''
+    Nearest-rank percentile of sorted values.
+    '''
+    if not values:
+        return 0.0
+    rank = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values))) - 1))
+    return values[rank]
+
+
+class Stats(object):
+    '''
+    Latencies and errors per step, safe to record into from many threads.
+    '''
+
+    def __init__(self):
+        self.latencies = dict((step, []) for step in STEPS)
+        self.errors = dict((step, 0) for step in STEPS)
+        self._lock = threading.Lock()
+
+    def record(self, step, seconds, ok):
+        with self._lock:
+            self.latencies[step].append(seconds)
+            if not ok:
+                self.errors[step] += 1
+
+    def summary(self):
+        summary = {}
+        for step in STEPS:
+            values = sorted(self.latencies[step])
+            summary[step] = {
+                'count': len(values),
+                'errors': self.errors[step],
+                'mean': sum(values) / len(values) if values else 0.0,
+                'p50': percentile(values, 50),
+                'p95': percentile(values, 95),
+                'p99': percentile(values, 99)}
+        return summary
+
+
+def parse_distribution(text):
+    '''
+    Parses "20:0.5,100:0.4,1000:0.1" into [(20, 0.5), (100, 0.4), (1000, 0.1)].
+    '''
+    pairs = []
+    for part in text.split(','):
+        size, _, weight = part.partition(':')
+        pairs.append((int(size), float(weight or 1)))
+    return pairs
+
+
+def choose(rng, distribution):
+    total = sum(weight for size, weight in distribution)
+    pick = rng.uniform(0, total)
+    for size, weight in distribution:
+        pick -= weight
+        if pick <= 0:
+            return size
+    return distribution[-1][0]
+
+
+#########
+# flows #
+#########
+
+
+class FlowError(Exception):
+    pass
+
+
+def run_flow(base, userId, yearValue, stats, stub):
+    '''
+    One instructor's visit, from the login page to the confirmation.
+    '''
+    client = requests.Session()
+
+    def step(name, method, path, expect, **kwargs):
+        start = time.time()
+        try:
+            r = client.request(method, base + path, allow_redirects=False,
+                               timeout=120, **kwargs)
+        except requests.RequestException as e:
+            stats.record(name, time.time() - start, False)
+            raise FlowError('{0}: {1!r}'.format(name, e))
+        ok = r.status_code in expect
+        stats.record(name, time.time() - start, ok)
+        if not ok:
+            raise FlowError('{0}: HTTP {1}'.format(name, r.status_code))
+        return r
+
+    step('login', 'GET', '/login', (200,))
+    step('token', 'GET', '/token?x_a={0}&x_b={0}'.format(userId), (302,))
+    step('semester', 'GET', '/semester', (200,))
+    choice = {'semester': 'Fall', 'year': yearValue}
+    while True:
+        r = step('choose semester', 'POST', '/semester', (200, 302), data=choice)
+        if r.status_code == 302:
+            break
+        # still fetching enrollments; wait as the page's script does
+        while client.get(base + '/semester/status').json()['pending']:
+            time.sleep(0.2)
+    step('enrollments', 'GET', '/enrollments', (200,))
+    step('add class', 'POST', '/enrollments', (302,), data={
+        'btn': 'Add Class',
+        'add_form-subject': 'MATH', 'add_form-catalogNumber': '104',
+        'add_form-section': '001C', 'add_form-sessionLength': '14W',
+        'add_form-classNumber': str(10000 + int(userId) % 80000)})
+    courseIds = [str(100000 + n) for n in range(min(2, stub.enrollment_count(userId)))]
+    step('submit', 'POST', '/enrollments', (302,), data={
+        'btn': 'Submit Request', 'form-courseIds': courseIds,
+        'form-baseCourse': courseIds[-1]})
+    step('confirmation', 'GET', '/confirmation', (200,))
+
+
+def run(flows, concurrency, distribution, latency, seed):
+    import views
+    from werkzeug.serving import make_server
+    app = views.create_app(debug=True)
+
+    yearValue = str(date.today().year - 1945)
+    semCode = views.get_semester('Fall', yearValue)
+    rng = random.Random(seed)
+    sizes = {}
+    for n in range(flows):
+        sizes[str(n + 1)] = choose(rng, distribution)
+
+    stub = run.stub
+    stub.semCode = semCode
+    stub.latency = latency
+    stub.enrollments = lambda userId: sizes.get(userId, 1)
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    base = 'http://127.0.0.1:{0}'.format(server.server_port)
+
+    stats = Stats()
+    failures = []
+
+    def flow(userId):
+        try:
+            run_flow(base, userId, yearValue, stats, stub)
+        except FlowError as e:
+            failures.append(str(e))
+
+    started = time.time()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        list(executor.map(flow, sorted(sizes, key=int)))
+    finally:
+        executor.shutdown()
+    elapsed = time.time() - started
+    server.shutdown()
+    server.server_close()
+    thread.join()
+    return stats, failures, elapsed
+
+
+def report(stats, failures, elapsed, flows, sink):
+    summary = stats.summary()
+    print('{0:<18}{1:>7}{2:>7}{3:>10}{4:>10}{5:>10}{6:>10}'.format(
+        'step', 'count', 'errors', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for step in STEPS:
+        s = summary[step]
+        print('{0:<18}{1:>7}{2:>7}{3:>10.1f}{4:>10.1f}{5:>10.1f}{6:>10.1f}'.format(
+            step, s['count'], s['errors'], s['mean'] * 1e3, s['p50'] * 1e3,
+            s['p95'] * 1e3, s['p99'] * 1e3))
+    handled = sum(s['count'] for s in summary.values())
+    completed = flows - len(failures)
+    print('\n{0} of {1} flows completed in {2:.1f}s: {3:.1f} flows/s, '
+          '{4:.1f} requests/s, {5} messages delivered'.format(
+              completed, flows, elapsed, completed / elapsed,
+              handled / elapsed, sink.messages))
+    for failure in failures[:10]:
+        print('  failed: ' + failure)
+    return {'steps': summary, 'flows': flows, 'completed': completed,
+            'seconds': elapsed, 'messages': sink.messages}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--flows', type=int, default=100,
+        help='instructors to run through the flow (default 100)')
+    parser.add_argument('--concurrency', type=int, default=10,
+        help='instructors in flight at once (default 10)')
+    parser.add_argument('--enrollments', default='20:0.5,100:0.4,1000:0.1',
+        help='enrollment counts and their weights (default 20:0.5,100:0.4,1000:0.1)')
+    parser.add_argument('--page-size', type=int, default=100,
+        help='enrollments per stub page (default 100)')
+    parser.add_argument('--latency', type=float, default=0.0,
+        help='seconds the stub waits before each reply (default 0)')
+    parser.add_argument('--seed', type=int, default=1,
+        help='seed for drawing enrollment counts (default 1)')
+    parser.add_argument('--output', help='write the report as JSON to this file')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='enrollments-load-')
+    run.stub = StubValence(page_size=args.page_size).start()
+    sink = StubSMTP().start()
+    try:
+        write_settings(workdir, run.stub.host, mail_port=sink.port,
+                       suppress_mail=False, PREFETCH_WAIT=30,
+                       MAIL_OUTBOX_BATCH=50)
+        stats, failures, elapsed = run(args.flows, args.concurrency,
+            parse_distribution(args.enrollments), args.latency, args.seed)
+        # let the outbox finish handing the confirmations to the sink
+        deadline = time.time() + 10
+        while sink.messages < 2 * (args.flows - len(failures)) and time.time() < deadline:
+            time.sleep(0.1)
+    finally:
+        # stop the app's mail sender first, so interpreter shutdown does not
+        # cut it off mid-pass
+        if 'views' in sys.modules:
+            sys.modules['views'].mailOutbox.stop()
+        run.stub.stop()
+        sink.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    # after the stubs are stopped, so the report is the last thing printed
+    result = report(stats, failures, elapsed, args.flows, sink)
+
+    if args.output:
+        result['meta'] = vars(args)
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
@@ -0,0 +1,61 @@
+# enrollments/benchmarks/settings.py
+#
+# App settings for running the app against the stub Valence server.
+
+import os
+
+
+SETTINGS = '''
+WTF_CSRF_ENABLED = {csrf!r}
+APP_ID = 'stub-app-id'
+APP_KEY = 'stub-app-key'
+HOST = 'localhost'
+PORT = '5000'
+SCHEME = 'HTTP'
+LMS_HOST = {lms_host!r}
+LMS_PORT = '80'
+ENCRYPT_REQUESTS = False
+VER = '1.4'
+AUTH_ROUTE = "/token"
+AUTH_CB = 'http://localhost:5000/token'
+VALENCE_WARM_UP = 0
+COURSE_UNIT_TYPE_ID = '3'
+ORG_UNIT_TYPE_ID = '3'
+ROLE_ID = '914'
+USER_ID = 'stub-service-id'
+USER_KEY = 'stub-service-key'
+FALL = '0'
+SPRING = '5'
+SUMMER = '8'
+SESSION_BACKEND = 'memory'
+JINJA_CACHE_DIR = {var!r} + '/jinja'
+MAIL_SERVER = {mail_host!r}
+MAIL_PORT = {mail_port!r}
+MAIL_USE_SSL = False
+MAIL_SUPPRESS_SEND = {suppress_mail!r}
+MAIL_DEFAULT_SENDER = 'combine@example.edu'
+EMAIL_DOMAIN = 'example.edu'
+EMAIL_SITE_ADMIN = 'd2l@example.edu'
+MAIL_OUTBOX_PATH = {var!r} + '/outbox.db'
+MAIL_OUTBOX_INTERVAL = 0.5
+LEDGER_PATH = {var!r} + '/ledger.db'
+REDIRECT_AFTER_LOGOUT = 'http://localhost/'
+'''
+
+
+def write_settings(directory, lms_host, mail_host='127.0.0.1', mail_port=25,
+                   suppress_mail=True, csrf=False, **extra):
+    '''
+    Writes a settings file for the app into directory and points
+    ENROLLMENTS_SETTINGS at it. Must run before views is imported.
+    '''
+    var = os.path.join(directory, 'var')
+    path = os.path.join(directory, 'bench_config.cfg')
+    with open(path, 'w') as f:
+        f.write(SETTINGS.format(lms_host=lms_host, var=var, csrf=csrf,
+                                mail_host=mail_host, mail_port=mail_port,
+                                suppress_mail=suppress_mail))
+        for key, value in sorted(extra.items()):
+            f.write('{0} = {1!r}\n'.format(key, value))
+    os.environ['ENROLLMENTS_SETTINGS'] = path
+    return path
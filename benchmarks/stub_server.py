@@ -0,0 +1,61 @@
+# enrollments/benchmarks/stub_server.py
+#
+# Threaded socket server shared by the stub Valence server and SMTP sink.
+
+import socket
+import threading
+
+try:
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from SocketServer import ThreadingMixIn
+
+
+class StoppableThreadingMixIn(ThreadingMixIn):
+    '''
+    ThreadingMixIn that keeps track of its handler threads, so stop() can
+    close the connections still open (e.g. idle keep-alive connections
+    from the app's pool) and wait for their threads. Otherwise they are
+    killed at interpreter shutdown, printing tracebacks after the results.
+    '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def process_request(self, request, client_address):
+        # only called from the serve_forever thread
+        if not hasattr(self, '_handlers'):
+            self._handlers = {}
+            self._handlersLock = threading.Lock()
+        thread = threading.Thread(target=self._handle,
+                                  args=(request, client_address))
+        thread.daemon = True
+        with self._handlersLock:
+            self._handlers[thread] = request
+        thread.start()
+
+    def _handle(self, request, client_address):
+        try:
+            self.process_request_thread(request, client_address)
+        finally:
+            with self._handlersLock:
+                self._handlers.pop(threading.current_thread(), None)
+
+    def stop(self, timeout=5):
+        '''
+        Stops serving, closes open connections and waits for their
+        handler threads.
+        '''
+        self.shutdown()
+        self.server_close()
+        if not hasattr(self, '_handlers'):
+            return
+        with self._handlersLock:
+            handlers = list(self._handlers.items())
+        for thread, request in handlers:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        for thread, request in handlers:
+            thread.join(timeout)
@@ -0,0 +1,97 @@
+# enrollments/benchmarks/stub_smtp.py
+#
+# A local SMTP sink that accepts and counts messages, for load tests that
+# exercise the app's real mail path without sending anything.
+#
+#     python benchmarks/stub_smtp.py [port]
+
+import socket
+import sys
+import threading
+
+try:
+    from socketserver import StreamRequestHandler, TCPServer
+except ImportError:
+    from SocketServer import StreamRequestHandler, TCPServer
+
+from stub_server import StoppableThreadingMixIn
+
+
+class SinkHandler(StreamRequestHandler):
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        StreamRequestHandler.setup(self)
+
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode('ascii'))
+
+    def handle(self):
+        self.reply('220 stub SMTP sink')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('ascii', 'replace').strip().upper()
+            if command.startswith('EHLO'):
+                self.wfile.write(b'250-stub\r\n250 8BITMIME\r\n')
+            elif command.startswith('DATA'):
+                self.reply('354 end data with <CR><LF>.<CR><LF>')
+                size = 0
+                while True:
+                    data = self.rfile.readline()
+                    if not data or data in (b'.\r\n', b'.\n'):
+                        break
+                    size += len(data)
+                self.server.sink.received(size)
+                self.reply('250 OK')
+            elif command.startswith('QUIT'):
+                self.reply('221 bye')
+                return
+            else:
+                # HELO, MAIL, RCPT, RSET, NOOP
+                self.reply('250 OK')
+
+
+class _Server(StoppableThreadingMixIn, TCPServer):
+    pass
+
+
+class StubSMTP(object):
+    '''
+    Threaded SMTP sink on 127.0.0.1 that keeps a count of messages.
+    '''
+
+    def __init__(self, port=0):
+        self.messages = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self.server = _Server(('127.0.0.1', port), SinkHandler)
+        self.server.sink = self
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def received(self, size):
+        with self._lock:
+            self.messages += 1
+            self.bytes += size
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.stop()
+        self._thread.join()
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8025
+    sink = StubSMTP(port=port)
+    print('Stub SMTP sink on 127.0.0.1:{0}'.format(sink.port))
+    sink.server.serve_forever()
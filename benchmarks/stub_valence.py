@@ -0,0 +1,206 @@
+# enrollments/benchmarks/stub_valence.py
+#
+# A local stand-in for the D2L Valence routes the app calls, for running
+# benchmarks and load tests without a D2L instance.
+#
+#     python benchmarks/stub_valence.py [port]
+
+import json
+import re
+import socket
+import sys
+import threading
+import time
+import zlib
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import urlsplit, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urlparse import urlsplit, parse_qs
+
+from stub_server import StoppableThreadingMixIn
+
+
+WHOAMI = re.compile(r'^/d2l/api/lp/[^/]+/users/whoami$')
+ENROLLMENTS = re.compile(r'^/d2l/api/lp/[^/]+/enrollments/users/([^/]+)/orgUnits/$')
+ORGSTRUCTURE = re.compile(r'^/d2l/api/lp/[^/]+/orgstructure/$')
+ORG_UNIT_USERS = re.compile(r'^/d2l/api/lp/[^/]+/enrollments/orgUnits/(\d+)/users/$')
+FULL_CODE = re.compile(r'^[^_]+_\d{4}_[^_]+_[^_]+_[^_]+_SEC[^_]+_[^_]+$')
+
+SUBJECTS = ('MATH', 'ENGLISH', 'BIOLOGY', 'HISTORY', 'CRIM JUS', 'PSYCH')
+SESSIONS = ('14W', '7W1', '7W2', '8W')
+
+
+def course_code(n, semCode='1145'):
+    '''
+    Builds a plausible UWOSH course code for the n-th stub course.
+    '''
+    return 'UWOSH_{0}_{1}_{2}_{3:03d}_SEC{4:03d}C_{5:05d}'.format(
+        semCode, SESSIONS[n % len(SESSIONS)], SUBJECTS[n % len(SUBJECTS)],
+        100 + n % 400, n % 100, 10000 + n)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        # keep-alive replies written in several pieces are otherwise held
+        # back by Nagle's algorithm waiting on the client's delayed ACK
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        BaseHTTPRequestHandler.setup(self)
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self._reply(200, {}, body=False)
+
+    def do_GET(self):
+        stub = self.server.stub
+        if stub.latency:
+            time.sleep(stub.latency)
+        stub.count()
+        parts = urlsplit(self.path)
+        query = dict((k, v[0]) for k, v in parse_qs(parts.query).items())
+        path = parts.path
+        if WHOAMI.match(path):
+            userId = query.get('x_b', 'anonymous')
+            return self._reply(200, {'Identifier': userId,
+                                     'FirstName': 'Stub',
+                                     'LastName': 'Instructor ' + userId,
+                                     'UniqueName': 'stub' + userId})
+        match = ENROLLMENTS.match(path)
+        if match:
+            return self._reply(200, stub.enrollment_page(match.group(1),
+                                                         query.get('bookmark')))
+        if ORGSTRUCTURE.match(path):
+            return self._reply(200, stub.orgstructure(query))
+        match = ORG_UNIT_USERS.match(path)
+        if match:
+            return self._reply(200, stub.org_unit_users_page(
+                query.get('bookmark')))
+        if path == '/d2l/api/versions/':
+            return self._reply(200, [])
+        self._reply(404, {'Error': 'Not found'})
+
+    def _reply(self, status, payload, body=True):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data) if body else 0))
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+
+class _Server(StoppableThreadingMixIn, HTTPServer):
+    pass
+
+
+class StubValence(object):
+    '''
+    Threaded stub Valence server on 127.0.0.1.
+
+    :param enrollments: Number of enrollments for each user, or a function
+        of the user id returning it.
+    :param page_size: Enrollment items per page; further pages are reached
+        through bookmarks as in D2L.
+    :param latency: Seconds to sleep before answering each request.
+    :param semCode: Semester code used in the generated course codes.
+    :param instructors: Number of instructors listed in any org unit, with
+        Identifiers '1' to str(instructors).
+    :param offerings: Number of course offerings in the semester, listed
+        when orgstructure is filtered on part of a code.
+    '''
+
+    def __init__(self, enrollments=50, page_size=100, latency=0.0,
+                 semCode='1145', instructors=20, offerings=2000, port=0):
+        self.enrollments = enrollments
+        self.instructors = instructors
+        self.offerings = offerings
+        self.page_size = page_size
+        self.latency = latency
+        self.semCode = semCode
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.server = _Server(('127.0.0.1', port), StubHandler)
+        self.server.stub = self
+        self._thread = None
+
+    @property
+    def host(self):
+        return '127.0.0.1:{0}'.format(self.server.server_address[1])
+
+    def count(self):
+        with self._lock:
+            self.requests += 1
+
+    def enrollment_count(self, userId):
+        if callable(self.enrollments):
+            return self.enrollments(userId)
+        return self.enrollments
+
+    def enrollment_page(self, userId, bookmark=None):
+        total = self.enrollment_count(userId)
+        start = int(bookmark) if bookmark else 0
+        end = min(total, start + self.page_size)
+        items = [{'OrgUnit': {'Id': 100000 + n,
+                              'Type': {'Id': 3, 'Code': 'Course Offering',
+                                       'Name': 'Course Offering'},
+                              'Name': 'Stub Course {0}'.format(n),
+                              'Code': course_code(n, self.semCode)},
+                  'Role': {'Id': 914, 'Code': None, 'Name': 'Instructor'}}
+                 for n in range(start, end)]
+        return {'PagingInfo': {'Bookmark': str(end), 'HasMoreItems': end < total},
+                'Items': items}
+
+    def org_unit_users_page(self, bookmark=None):
+        start = int(bookmark) if bookmark else 0
+        end = min(self.instructors, start + self.page_size)
+        items = [{'User': {'Identifier': str(n), 'DisplayName': 'Stub Instructor {0}'.format(n)},
+                  'Role': {'Id': 914, 'Code': None, 'Name': 'Instructor'}}
+                 for n in range(start + 1, end + 1)]
+        return {'PagingInfo': {'Bookmark': str(end), 'HasMoreItems': end < self.instructors},
+                'Items': items}
+
+    def org_unit(self, code):
+        return {'Identifier': str(200000 + zlib.crc32(code.encode('utf-8')) % 100000),
+                'Name': 'Stub Offering ' + code.split('_')[3],
+                'Code': code,
+                'Type': {'Id': 3, 'Code': 'Course Offering',
+                         'Name': 'Course Offering'}}
+
+    def orgstructure(self, query):
+        code = query.get('orgUnitCode', '')
+        if FULL_CODE.match(code):
+            # one offering for any full code but those of unknown classes
+            items = [] if code.endswith('99999') else [self.org_unit(code)]
+            return {'PagingInfo': {'Bookmark': '', 'HasMoreItems': False},
+                    'Items': items}
+        # part of a code lists every matching offering of the semester
+        codes = [c for c in (course_code(n, self.semCode)
+                             for n in range(self.offerings)) if code in c]
+        start = int(query['bookmark']) if query.get('bookmark') else 0
+        end = min(len(codes), start + self.page_size)
+        return {'PagingInfo': {'Bookmark': str(end), 'HasMoreItems': end < len(codes)},
+                'Items': [self.org_unit(c) for c in codes[start:end]]}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.stop()
+        self._thread.join()
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8099
+    stub = StubValence(port=port)
+    print('Stub Valence server on http://{0}'.format(stub.host))
+    stub.server.serve_forever()
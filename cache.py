@@ -0,0 +1,296 @@
+# enrollments/cache.py
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+#########
+# cache #
+#########
+
+
+class LRUCache(object):
+    '''
+    Thread-safe mapping that keeps at most `max_entries` items, dropping the
+    least recently used first.
+    '''
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.hits = self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._items.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class UserContextCache(object):
+    '''
+    Live D2LUserContext objects keyed by session, so each request does not
+    rebuild (and re-validate) its context from the stored properties. A
+    cached context is only reused while its key, skew and other properties
+    still match the session's copy.
+    '''
+
+    def __init__(self, appContext, max_entries=5000):
+        self.appContext = appContext
+        self._contexts = LRUCache(max_entries)
+
+    def get(self, key, props):
+        '''
+        Returns the user context for key built from props.
+        '''
+        fingerprint = (props['host'], props['user_id'], props['user_key'],
+                       props['encrypt_requests'], props['server_skew'],
+                       self.appContext.app_id, self.appContext.app_key)
+        cached = self._contexts.get(key)
+        if cached is not None and cached[0] == fingerprint:
+            return cached[1]
+        uc = self.appContext.create_user_context(
+            d2l_user_context_props_dict=props)
+        self._contexts.set(key, (fingerprint, uc))
+        return uc
+
+    def invalidate(self, key):
+        self._contexts.pop(key)
+
+
+class LookupCache(object):
+    '''
+    Shared cache of org unit lookups keyed by (orgUnitCode, orgUnitType).
+    Found org units are kept for `ttl` seconds and codes D2L does not know
+    (negative entries) for `negative_ttl` seconds, at most `max_entries`
+    of them in all.
+    '''
+
+    def __init__(self, ttl=3600, negative_ttl=300, max_entries=10000):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = self.negative_hits = self.misses = 0
+        self._items = LRUCache(max_entries)
+
+    def get(self, orgUnitCode, orgUnitType):
+        '''
+        Returns the cached org unit (or False) for the code, or None if it
+        has not been looked up recently.
+        '''
+        item = self._items.get((orgUnitCode, orgUnitType))
+        if item is not None and item[1] > time.time():
+            if item[0]:
+                self.hits += 1
+            else:
+                self.negative_hits += 1
+            return item[0]
+        self.misses += 1
+        return None
+
+    def set(self, orgUnitCode, orgUnitType, value):
+        ttl = self.ttl if value else self.negative_ttl
+        self._items.set((orgUnitCode, orgUnitType), (value, time.time() + ttl))
+
+    def invalidate(self, orgUnitCode, orgUnitType):
+        self._items.pop((orgUnitCode, orgUnitType))
+
+    def __len__(self):
+        return len(self._items)
+
+
+class _Entry(object):
+    __slots__ = ('payload', 'size', 'stored')
+
+    def __init__(self, payload, stored):
+        self.payload = payload
+        self.size = len(payload)
+        self.stored = stored
+
+
+class EnrollmentCache(object):
+    '''
+    Process-wide cache of semester-grouped course indexes keyed by D2L user
+    Identifier.
+
+    Entries younger than `ttl` seconds are served as-is. Entries younger than
+    `ttl + stale` are served immediately while a refresh runs in the
+    background. Older or missing entries are refreshed in the background
+    too; the caller waits up to `budget` seconds for it and, if D2L is slower
+    than that, gets the last known value instead. Entries are evicted least
+    recently used first once there are more than `max_entries` of them or
+    their JSON payloads add up to more than `max_bytes`.
+
+    With a `shared` store (see stores.py) entries are also written there,
+    and a process that does not hold an entry picks it up from the store
+    before going to D2L, so every worker on the host - and the warm-up
+    job - fills the cache for all of them.
+    '''
+
+    def __init__(self, ttl=900, stale=3600, budget=2.0, max_entries=2000,
+                 max_bytes=64 * 1024 * 1024, max_workers=4, shared=None):
+        self.ttl = ttl
+        self.stale = stale
+        self.budget = budget
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self.bytes = 0
+        self.hits = self.stale_hits = self.misses = 0
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def get_or_load(self, key, loader, budget=None):
+        '''
+        Returns the cached value for key, calling loader() to refresh it as
+        described above.
+        '''
+        if budget is None:
+            budget = self.budget
+        entry = self._entry(key)
+        now = time.time()
+        with self._lock:
+            if entry is not None:
+                age = now - entry.stored
+                if age < self.ttl:
+                    self.hits += 1
+                    return json.loads(entry.payload)
+                if age < self.ttl + self.stale:
+                    self.stale_hits += 1
+                    self._refresh(key, loader)
+                    return json.loads(entry.payload)
+            self.misses += 1
+            future = self._refresh(key, loader)
+        if entry is None:
+            return future.result()
+        try:
+            return future.result(timeout=budget)
+        except Exception:
+            # D2L is slow or failing; fall back to the last known list
+            return json.loads(entry.payload)
+
+    def get(self, key):
+        '''
+        Returns the cached value for key regardless of age, or None.
+        '''
+        entry = self._entry(key)
+        return None if entry is None else json.loads(entry.payload)
+
+    def fresh(self, key):
+        '''
+        True if key holds an entry younger than the TTL.
+        '''
+        entry = self._entry(key)
+        return entry is not None and time.time() - entry.stored < self.ttl
+
+    def set(self, key, value):
+        payload = json.dumps(value, separators=(',', ':'))
+        entry = _Entry(payload, time.time())
+        with self._lock:
+            self._store(key, entry)
+        self._share(key, entry)
+
+    def invalidate(self, key):
+        '''
+        Drops key so the next lookup goes back to D2L.
+        '''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry.size
+        if self.shared is not None:
+            self.shared.delete(str(key))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _refresh(self, key, loader):
+        # called with the lock held; at most one refresh per key at a time
+        future = self._pending.get(key)
+        if future is None:
+            future = self._executor.submit(self._load, key, loader)
+            self._pending[key] = future
+        return future
+
+    def _entry(self, key):
+        # the entry for key from this process, else from the shared store
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = self._entries.pop(key)
+                return entry
+        if self.shared is None:
+            return None
+        item = self.shared.get(str(key))
+        if item is None:
+            return None
+        entry = _Entry(item['payload'], item['stored'])
+        with self._lock:
+            self._store(key, entry)
+        return entry
+
+    def _share(self, key, entry):
+        if self.shared is not None:
+            self.shared.set(str(key),
+                            {'payload': entry.payload, 'stored': entry.stored},
+                            self.ttl + self.stale)
+
+    def _load(self, key, loader):
+        try:
+            value = loader()
+            payload = json.dumps(value, separators=(',', ':'))
+            entry = _Entry(payload, time.time())
+            with self._lock:
+                self._store(key, entry)
+            self._share(key, entry)
+            return json.loads(payload)
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def _store(self, key, entry):
+        # called with the lock held
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old.size
+        if entry.size > self.max_bytes:
+            return
+        self._entries[key] = entry
+        self.bytes += entry.size
+        while (len(self._entries) > self.max_entries or
+               self.bytes > self.max_bytes):
+            evicted_key, evicted = self._entries.popitem(last=False)
+            self.bytes -= evicted.size
@@ -0,0 +1,275 @@
+# enrollments/courses.py
+
+import binascii
+import os
+import re
+
+
+# UWOSH_0655_14W_MATH_104_SEC001C_12345: institution, semester code, session
+# length, subject, catalog number, section and class number
+CODE_PATTERN = re.compile(r'^([^_]+)_(\d{4})_([^_]+)_([^_]+)_([^_]+)_SEC([^_]+)_([^_]+)$')
+
+# parsed codes remembered per process before the memo is started over
+MAX_PARSED = 50000
+# shared code fields kept per process before the table is started over; codes
+# typed into the add class form go through it too
+MAX_INTERNED = 5000
+
+
+################
+# course codes #
+################
+
+
+_interned = {}
+
+
+def _intern(value):
+    # one shared copy of each institution, semester, session and subject
+    # string; works for the unicode strings JSON gives on Python 2, unlike
+    # the intern builtin
+    try:
+        return _interned[value]
+    except KeyError:
+        pass
+    if len(_interned) >= MAX_INTERNED:
+        _interned.clear()
+    _interned[value] = value
+    return value
+
+
+class CourseCode(object):
+    '''
+    The fields of a UWOSH course offering code. `code` is the full code and
+    `short` the SUBJECT CATALOG SECTION label shown to users.
+    '''
+
+    __slots__ = ('institution', 'semCode', 'sessionLength', 'subject',
+                 'catalogNumber', 'section', 'classNumber', 'code', 'short')
+
+    def __init__(self, institution, semCode, sessionLength, subject,
+                 catalogNumber, section, classNumber, code=None):
+        self.institution = _intern(institution)
+        self.semCode = _intern(semCode)
+        self.sessionLength = _intern(sessionLength)
+        self.subject = _intern(subject)
+        self.catalogNumber = catalogNumber
+        self.section = section
+        self.classNumber = classNumber
+        self.code = code or '_'.join((institution, semCode, sessionLength,
+            subject, catalogNumber, 'SEC' + section, classNumber))
+        self.short = subject + ' ' + catalogNumber + ' SEC' + section
+
+    def __eq__(self, other):
+        return isinstance(other, CourseCode) and other.code == self.code
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.code)
+
+    def __repr__(self):
+        return 'CourseCode({0!r})'.format(self.code)
+
+
+_parsed = {}
+
+
+def _parse(code):
+    match = CODE_PATTERN.match(code)
+    parsed = None if match is None else CourseCode(*match.groups(), code=code)
+    if len(_parsed) >= MAX_PARSED:
+        _parsed.clear()
+    _parsed[code] = parsed
+    return parsed
+
+
+def parse_course_code(code):
+    '''
+    Returns the CourseCode for code, or None if code is not a UWOSH course
+    offering code. Results are remembered.
+    '''
+    try:
+        return _parsed[code]
+    except KeyError:
+        return _parse(code)
+
+
+def parse_codes(codes):
+    '''
+    Parses a page of codes at once, returning a CourseCode or None for each.
+    '''
+    parsed = _parsed
+    return [parsed[code] if code in parsed else _parse(code)
+            for code in codes]
+
+
+def make_code(semCode, sessionLength, subject, catalogNumber, section,
+              classNumber, institution='UWOSH'):
+    '''
+    Creates code from the elements submitted in the add forms; the inverse
+    of parse_course_code.
+    '''
+    return CourseCode(institution, semCode, sessionLength, subject,
+                      catalogNumber, section, classNumber).code
+
+
+def parse_code(code):
+    '''
+    Breaks up code into more readable version to present to user.
+    '''
+    parsed = parse_course_code(code)
+    if parsed is not None:
+        return parsed.short
+    return ' '.join(code.split('_')[3:6]) or code
+
+
+###########
+# courses #
+###########
+
+
+class Course(object):
+    '''
+    A D2L course offering the user can ask to have combined.
+    '''
+
+    __slots__ = ('courseId', 'name', 'code', 'parsed')
+
+    def __init__(self, courseId, name, code, parsed=None):
+        self.courseId = int(courseId)
+        self.name = name
+        fields = parse_course_code(code)
+        if fields is not None:
+            # every session holding this course in the process shares one
+            # copy of its code and label
+            self.code = fields.code
+            self.parsed = fields.short
+        else:
+            self.code = code
+            self.parsed = parse_code(code) if parsed is None else parsed
+
+    def __getitem__(self, key):
+        # lets templates and mail helpers written against dicts use courses
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __eq__(self, other):
+        return isinstance(other, Course) and other.courseId == self.courseId
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.courseId)
+
+    def to_dict(self):
+        return {u'courseId': self.courseId,
+                u'name': self.name,
+                u'code': self.code,
+                u'parsed': self.parsed}
+
+
+def _new_stamp():
+    return binascii.hexlify(os.urandom(6)).decode('ascii')
+
+
+class CourseIndex(object):
+    '''
+    A user's courses grouped by semester code, with constant-time lookup by
+    courseId and by code. Serializes to a compact JSON-friendly form for the
+    session and the enrollment cache.
+    '''
+
+    __slots__ = ('byId', 'byCode', 'semesters', 'semCodes', 'version',
+                 'stamp')
+
+    def __init__(self):
+        self.byId = {}
+        self.byCode = {}
+        self.semesters = {}
+        # semester code of each courseId
+        self.semCodes = {}
+        # stamp is new after every change and kept across serialization, so
+        # it names one state of the course list even when sessions holding
+        # the same cached list each add a different course; version counts
+        # the changes
+        self.version = 0
+        self.stamp = _new_stamp()
+
+    def add(self, semCode, courseId, name, code, parsed=None):
+        '''
+        Adds a course to a semester, returning the indexed Course. A course
+        already in the index is returned as-is.
+        '''
+        course = self.byId.get(int(courseId))
+        if course is not None:
+            return course
+        course = self._insert(semCode, courseId, name, code, parsed)
+        self.version += 1
+        self.stamp = _new_stamp()
+        return course
+
+    def _insert(self, semCode, courseId, name, code, parsed=None):
+        course = Course(courseId, name, code, parsed)
+        semCode = _intern(semCode)
+        self.byId[course.courseId] = course
+        self.byCode[course.code] = course
+        self.semesters.setdefault(semCode, []).append(course)
+        self.semCodes[course.courseId] = semCode
+        return course
+
+    def get(self, courseId, semCode=None):
+        '''
+        Returns the course with courseId, or None. With semCode, only a
+        course of that semester is returned.
+        '''
+        try:
+            courseId = int(courseId)
+        except (TypeError, ValueError):
+            return None
+        if semCode is not None and self.semCodes.get(courseId) != semCode:
+            return None
+        return self.byId.get(courseId)
+
+    def find_code(self, code):
+        return self.byCode.get(code)
+
+    def semester(self, semCode):
+        '''
+        Returns the semester's courses in the order they were added.
+        '''
+        return self.semesters.get(semCode, [])
+
+    def __contains__(self, courseId):
+        return int(courseId) in self.byId
+
+    def __len__(self):
+        return len(self.byId)
+
+    def to_data(self):
+        '''
+        Returns {'stamp': s, 'version': n, 'semesters': {semCode: [[courseId,
+        name, code, parsed], ...]}}.
+        '''
+        semesters = {}
+        for semCode, courses in self.semesters.items():
+            semesters[semCode] = [[c.courseId, c.name, c.code, c.parsed]
+                                  for c in courses]
+        return {'stamp': self.stamp, 'version': self.version,
+                'semesters': semesters}
+
+    @classmethod
+    def from_data(cls, data):
+        index = cls()
+        # rows were unique when serialized, and the stamp and version are
+        # the serialized ones, so rows go in without add()'s bookkeeping
+        for semCode, rows in data['semesters'].items():
+            for row in rows:
+                index._insert(semCode, *row)
+        index.version = data['version']
+        index.stamp = data['stamp']
+        return index
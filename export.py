@@ -0,0 +1,127 @@
+# enrollments/export.py
+#
+# Streams combine requests from the ledger as CSV or NDJSON, for the admin
+# export endpoint and from the command line:
+#
+#     python export.py --semester 0800 --status submitted --format csv > 0800.csv
+
+import argparse
+import csv
+import datetime
+import json
+import os
+import sys
+from ledger import Ledger
+
+
+FORMATS = ('csv', 'ndjson')
+
+MIMETYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+# one CSV row per course to combine
+CSV_COLUMNS = ('requestId', 'submitted', 'status', 'semCode', 'userId',
+               'uniqueName', 'firstName', 'lastName', 'baseCourseId',
+               'baseCourseCode', 'baseCourseParsed', 'courseId', 'courseCode',
+               'courseParsed', 'courseName')
+
+
+##########
+# export #
+##########
+
+
+class _Line(object):
+    # csv.writer target that hands back each formatted row
+    def write(self, value):
+        return value
+
+
+def _cell(value):
+    # the Python 2 csv module only writes byte strings
+    if value is None:
+        return ''
+    if str is bytes and not isinstance(value, bytes):
+        return unicode(value).encode('utf-8')
+    return value
+
+
+def _timestamp(submitted):
+    return datetime.datetime.utcfromtimestamp(submitted).strftime(
+        '%Y-%m-%dT%H:%M:%SZ')
+
+
+def iter_csv(requests):
+    '''
+    Yields a header line and then one CSV line per course in each request.
+    '''
+    writer = csv.writer(_Line())
+    yield writer.writerow(CSV_COLUMNS)
+    for r in requests:
+        base = r['baseCourse']
+        for course in r['courses']:
+            yield writer.writerow([_cell(v) for v in (
+                r['id'], _timestamp(r['submitted']), r['status'],
+                r['semCode'], r['userId'], r['uniqueName'], r['firstName'],
+                r['lastName'], base['courseId'], base['code'], base['parsed'],
+                course['courseId'], course['code'], course['parsed'],
+                course['name'])])
+
+
+def iter_ndjson(requests):
+    '''
+    Yields one JSON object per request, each on its own line.
+    '''
+    for r in requests:
+        record = dict(r)
+        record['submitted'] = _timestamp(r['submitted'])
+        del record['fingerprint']
+        yield json.dumps(record, sort_keys=True) + '\n'
+
+
+def iter_export(ledger, fmt, semCode=None, status=None, baseCourseId=None):
+    '''
+    Yields the matching requests in fmt, a chunk at a time, reading the
+    ledger one row at a time so memory use does not grow with the term.
+    '''
+    if fmt not in FORMATS:
+        raise ValueError('Unknown export format: {0}'.format(fmt))
+    requests = ledger.find(semCode=semCode, status=status,
+                           baseCourseId=baseCourseId)
+    return iter_csv(requests) if fmt == 'csv' else iter_ndjson(requests)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Export combine requests from the ledger.')
+    parser.add_argument('--ledger', help='ledger file (default: LEDGER_PATH '
+                        'from the settings file, else var/ledger.db)')
+    parser.add_argument('--format', choices=FORMATS, default='csv')
+    parser.add_argument('--semester', dest='semCode',
+                        help='semester code, e.g. 0800')
+    parser.add_argument('--status', help='e.g. submitted')
+    parser.add_argument('--base-course', dest='baseCourseId', type=int,
+                        help='courseId of the base course')
+    parser.add_argument('--output', '-o', help='file to write (default: stdout)')
+    args = parser.parse_args(argv)
+
+    path = args.ledger
+    if path is None:
+        from flask import Config
+        settings = Config(os.path.dirname(os.path.abspath(__file__)))
+        settings.from_pyfile(os.environ.get('ENROLLMENTS_SETTINGS',
+                                            'app_config.cfg'), silent=True)
+        path = settings.get('LEDGER_PATH', 'var/ledger.db')
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for chunk in iter_export(Ledger(path), args.format,
+                                 semCode=args.semCode, status=args.status,
+                                 baseCourseId=args.baseCourseId):
+            out.write(chunk)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
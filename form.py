@@ -1,8 +1,9 @@
 # enrollments/form.py
 
 from flask_wtf import Form
-from wtforms import SelectField, SelectMultipleField, widgets, RadioField, TextField, validators
+from wtforms import SelectField, SelectMultipleField, widgets, RadioField, TextField, TextAreaField, validators
 from datetime import date
+import re
 
 # semester values for four-digit semester codes
 FALL = '0'
@@ -12,10 +13,46 @@ SUMMER = '8'
 # base year for calculating semester code
 BASE_YEAR = 1945
 
+# PeopleSoft session lengths used in course codes
+SESSION_LENGTHS = [
+    ('8W', 'Eight Week'),
+    ('4W1', 'Four Week - First'),
+    ('4W2', 'Four Week - Second'),
+    ('14W', 'Fourteen Week'),
+    ('7W1', 'Seven Week - First'),
+    ('7W2', 'Seven Week - Second'),
+    ('17W', 'Seventeen Week'),
+    ('10W', 'Ten Week'),
+    ('3WI', 'Three Week Interim')
+    ]
+
+
+# year choices for the current calendar year, as (year, choices)
+_yearChoices = (None, None)
+
+
+def year_choices(today=None):
+    '''
+    Returns the year choices for the semester form: last year and this year,
+    valued by years since BASE_YEAR. Built once per calendar year, so a
+    long-running worker moves on to the new year on New Year's Day.
+    '''
+    global _yearChoices
+    thisYear = (today or date.today()).year
+    cached = _yearChoices
+    if cached[0] != thisYear:
+        cached = _yearChoices = (thisYear, [(str(year - BASE_YEAR), str(year))
+            for year in range(thisYear - 1, thisYear + 1)])
+    return cached[1]
+
 
 class SelectSemesterForm(Form):
     semester = SelectField('Select semester', choices=[('Fall', 'Fall'), ('Spring', 'Spring'), ('Summer', 'Summer')])
-    year = SelectField('Select year', choices=[(str(year - BASE_YEAR), str(year)) for year in range(date.today().year - 1, date.today().year + 1)])
+    year = SelectField('Select year')
+
+    def __init__(self, *args, **kwargs):
+        Form.__init__(self, *args, **kwargs)
+        self.year.choices = year_choices()
 
 
 class SelectCoursesForm(Form):
@@ -31,20 +68,54 @@ class AdditionalCourseForm(Form):
     sessionLength = SelectField('Session Length',
         default='14W',
         validators=[validators.required()],
-        choices=[
-            ('8W', 'Eight Week'),
-            ('4W1', 'Four Week - First'),
-            ('4W2', 'Four Week - Second'),
-            ('14W', 'Fourteen Week'),
-            ('7W1', 'Seven Week - First'),
-            ('7W2', 'Seven Week - Second'),
-            ('17W', 'Seventeen Week'),
-            ('10W', 'Ten Week'),
-            ('3WI', 'Three Week Interim')
-            ])
+        choices=SESSION_LENGTHS)
     subject = TextField('Subject Code', validators=[validators.required(message="Subject code is required."),
         validators.Regexp(regex=r'[a-zA-Z ]{3,8}', message="Please double check the subject.")])
     catalogNumber = TextField('Catalog Number', validators=[validators.required(message="Catalog Number is required."),
         validators.Regexp(regex=r'\d{3}', message="Please double check the catalog number.")])
     section = TextField('First 4-digits of section', validators=[validators.required(message="Section is required."),
-        validators.Regexp(regex=r'\d{3}[a-zA-Z]{1}', message="Please double check the section.")])
\ No newline at end of file
+        validators.Regexp(regex=r'\d{3}[a-zA-Z]{1}', message="Please double check the section.")])
+
+
+class BulkCourseForm(Form):
+    classes = TextAreaField('Classes', validators=[validators.required(message="Please list at least one class.")])
+    sessionLength = SelectField('Session Length',
+        default='14W',
+        validators=[validators.required()],
+        choices=SESSION_LENGTHS)
+
+
+# checks applied to each pasted row, matching AdditionalCourseForm
+ROW_CHECKS = (
+    ('subject', re.compile(r'[a-zA-Z ]{3,8}'), "Please double check the subject."),
+    ('catalogNumber', re.compile(r'\d{3}'), "Please double check the catalog number."),
+    ('section', re.compile(r'\d{3}[a-zA-Z]{1}'), "Please double check the section."),
+    ('classNumber', re.compile(r'\d{5}'), "Please double check the class number."))
+
+
+def parse_class_rows(text):
+    '''
+    Splits pasted "Subject Catalog# Section Class#" lines (e.g. "CRIM JUS 110
+    091C 92484") into dicts of add form fields. Returns the rows and a list
+    of (line, row text, message) errors for rows that could not be read.
+    '''
+    rows, errors = [], []
+    for line, rowText in enumerate(text.splitlines(), 1):
+        parts = rowText.replace(',', ' ').split()
+        if not parts:
+            continue
+        if len(parts) < 4:
+            errors.append((line, rowText, "Please list subject, catalog number, section and class number."))
+            continue
+        row = {'subject': ' '.join(parts[:-3]),
+               'catalogNumber': parts[-3],
+               'section': parts[-2],
+               'classNumber': parts[-1]}
+        for field, regex, message in ROW_CHECKS:
+            if not regex.match(row[field]):
+                errors.append((line, rowText, message))
+                break
+        else:
+            row['line'], row['text'] = line, rowText
+            rows.append(row)
+    return rows, errors
@@ -0,0 +1,36 @@
+# gunicorn.conf.py
+#
+# Multi-process serving, tuned from the app's settings file:
+#
+#     gunicorn -c gunicorn.conf.py wsgi:application
+
+import multiprocessing
+import os
+from flask import Config
+
+
+settings = Config(os.path.dirname(os.path.abspath(__file__)))
+settings.from_pyfile(os.environ.get('ENROLLMENTS_SETTINGS', 'app_config.cfg'))
+
+bind = settings.get('BIND', '127.0.0.1:8000')
+workers = settings.get('WORKERS', multiprocessing.cpu_count() * 2 + 1)
+threads = settings.get('WORKER_THREADS', 4)
+worker_class = 'gthread' if threads > 1 else 'sync'
+timeout = settings.get('WORKER_TIMEOUT', 60)
+# replace a worker after this many requests to bound its memory (0 never)
+max_requests = settings.get('WORKER_MAX_REQUESTS', 0)
+
+# import the app, compile templates and build caches once in the master so
+# workers share that memory copy-on-write
+preload_app = True
+
+if workers > 1 and settings.get('SESSION_BACKEND') == 'memory':
+    raise RuntimeError("SESSION_BACKEND = 'memory' keeps sessions in one "
+                       "worker; use 'sqlite' or 'cookie' with WORKERS > 1")
+
+
+def post_fork(server, worker):
+    # start this worker's mail sender and open its LMS connections before it
+    # takes its first request; everything else it builds on first use
+    from views import start_worker
+    start_worker()
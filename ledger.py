@@ -0,0 +1,133 @@
+# enrollments/ledger.py
+
+import hashlib
+import json
+import time
+from stores import SqliteConnections
+
+
+# statuses a combine request moves through
+SUBMITTED = 'submitted'
+COMBINED = 'combined'
+REJECTED = 'rejected'
+
+# columns of a ledger row, in the order rows are returned
+COLUMNS = ('id', 'fingerprint', 'userId', 'uniqueName', 'firstName',
+           'lastName', 'semCode', 'baseCourseId', 'baseCourse', 'courses',
+           'status', 'submitted')
+
+
+##########
+# ledger #
+##########
+
+
+def fingerprint(userId, semCode, baseCourseId, courseIds):
+    '''
+    Identifies a combine request by who asked, for which semester, into
+    which base course and which courses, whatever order the courses were
+    picked in.
+    '''
+    key = '{0}|{1}|{2}|{3}'.format(userId, semCode, int(baseCourseId),
+                                   ','.join(str(i) for i in sorted(int(i) for i in courseIds)))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class Ledger(object):
+    '''
+    Every confirmed combine request, in a local SQLite file shared by the
+    worker processes. Requests are indexed by user, semester, base course
+    and status, and unique by fingerprint so a repeated submission is found
+    with one index lookup instead of being recorded (and mailed) again.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = SqliteConnections(path)
+        with self._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS requests ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'fingerprint TEXT NOT NULL UNIQUE, '
+                         'userId TEXT NOT NULL, '
+                         'uniqueName TEXT, '
+                         'firstName TEXT, '
+                         'lastName TEXT, '
+                         'semCode TEXT NOT NULL, '
+                         'baseCourseId INTEGER NOT NULL, '
+                         'baseCourse TEXT NOT NULL, '
+                         'courses TEXT NOT NULL, '
+                         'status TEXT NOT NULL, '
+                         'submitted REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS requests_user '
+                         'ON requests (userId, submitted)')
+            conn.execute('CREATE INDEX IF NOT EXISTS requests_semester '
+                         'ON requests (semCode, status)')
+            conn.execute('CREATE INDEX IF NOT EXISTS requests_base '
+                         'ON requests (baseCourseId)')
+            conn.execute('CREATE INDEX IF NOT EXISTS requests_status '
+                         'ON requests (status, submitted)')
+
+    def record(self, userId, uniqueName, firstName, lastName, semCode,
+               baseCourse, courses):
+        '''
+        Records a combine request of course dicts into the baseCourse dict.
+        Returns (id, created); created is False when the same request was
+        already recorded, and id is then the earlier request's.
+        '''
+        key = fingerprint(userId, semCode, baseCourse['courseId'],
+                          [c['courseId'] for c in courses])
+        with self._connection() as conn:
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO requests (fingerprint, userId, '
+                'uniqueName, firstName, lastName, semCode, baseCourseId, '
+                'baseCourse, courses, status, submitted) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, str(userId), uniqueName, firstName, lastName, semCode,
+                 int(baseCourse['courseId']), json.dumps(baseCourse),
+                 json.dumps(courses), SUBMITTED, time.time()))
+            if cursor.rowcount:
+                return cursor.lastrowid, True
+            row = conn.execute('SELECT id FROM requests WHERE fingerprint = ?',
+                               (key,)).fetchone()
+        return row[0], False
+
+    def forget(self, id):
+        '''
+        Removes a request, e.g. one whose mail could not be queued.
+        '''
+        with self._connection() as conn:
+            conn.execute('DELETE FROM requests WHERE id = ?', (id,))
+
+    def set_status(self, id, status):
+        with self._connection() as conn:
+            conn.execute('UPDATE requests SET status = ? WHERE id = ?',
+                         (status, id))
+
+    def get(self, id):
+        row = self._connection().execute(
+            'SELECT {0} FROM requests WHERE id = ?'.format(', '.join(COLUMNS)),
+            (id,)).fetchone()
+        return None if row is None else self._request(row)
+
+    def find(self, userId=None, semCode=None, baseCourseId=None, status=None):
+        '''
+        Yields matching requests, oldest first, one row at a time.
+        '''
+        clauses, params = [], []
+        for column, value in (('userId', userId), ('semCode', semCode),
+                              ('baseCourseId', baseCourseId),
+                              ('status', status)):
+            if value is not None:
+                clauses.append('{0} = ?'.format(column))
+                params.append(str(value) if column == 'userId' else value)
+        query = 'SELECT {0} FROM requests'.format(', '.join(COLUMNS))
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        for row in self._connection().execute(query + ' ORDER BY id', params):
+            yield self._request(row)
+
+    def _request(self, row):
+        request = dict(zip(COLUMNS, row))
+        request['baseCourse'] = json.loads(request['baseCourse'])
+        request['courses'] = json.loads(request['courses'])
+        return request
@@ -0,0 +1,267 @@
+# enrollments/metrics.py
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+
+# default histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0)
+
+
+###########
+# metrics #
+###########
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, _escape(value))
+                          for name, value in pairs) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def snapshot(self):
+        '''
+        This process's values as a JSON-serializable list.
+        '''
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def merge(self, snapshots):
+        '''
+        Adds up snapshots, (worker, snapshot()) pairs from each process.
+        Returns the label names and the values by key.
+        '''
+        values = {}
+        for worker, items in snapshots:
+            for key, value in items:
+                key = tuple(key)
+                values[key] = self._add(values.get(key), value)
+        return self.labelnames, values
+
+    def _add(self, total, value):
+        return value if total is None else total + value
+
+    def render(self, snapshots=None):
+        '''
+        Renders this process's values or, given snapshots, every worker's.
+        '''
+        lines = ['# HELP {0} {1}'.format(self.name, self.documentation),
+                 '# TYPE {0} {1}'.format(self.name, self.kind)]
+        if snapshots is None:
+            labelnames = self.labelnames
+            with self._lock:
+                items = sorted(self._values.items())
+        else:
+            labelnames, values = self.merge(snapshots)
+            items = sorted(values.items())
+        for key, value in items:
+            lines.extend(self._samples(labelnames, key, value))
+        return lines
+
+    def _samples(self, labelnames, key, value):
+        return ['{0}{1} {2}'.format(self.name,
+                                    _format_labels(labelnames, key),
+                                    _format_value(value))]
+
+
+class Counter(_Metric):
+    '''
+    Monotonically increasing count.
+    '''
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    '''
+    Value that goes up and down.
+    '''
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def merge(self, snapshots):
+        # a gauge such as a hit ratio or queue depth cannot be added up, so
+        # each worker's value is kept under a worker label
+        values = {}
+        for worker, items in snapshots:
+            for key, value in items:
+                values[(str(worker),) + tuple(key)] = value
+        return ('worker',) + self.labelnames, values
+
+
+class Histogram(_Metric):
+    '''
+    Distribution of observed values over fixed buckets.
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        _Metric.__init__(self, name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # per-bucket counts, then the sum of observations
+                counts = self._values[key] = [0] * len(self.buckets) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), list(counts)]
+                    for key, counts in self._values.items()]
+
+    def _add(self, total, counts):
+        if total is None:
+            return list(counts)
+        return [a + b for a, b in zip(total, counts)]
+
+    def _samples(self, labelnames, key, counts):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append('{0}_bucket{1} {2}'.format(self.name,
+                _format_labels(labelnames, key,
+                               [('le', _format_value(bound))]),
+                cumulative))
+        labels = _format_labels(labelnames, key)
+        lines.append('{0}_sum{1} {2}'.format(self.name, labels,
+                                             _format_value(counts[-1])))
+        lines.append('{0}_count{1} {2}'.format(self.name, labels, cumulative))
+        return lines
+
+
+class Registry(object):
+    '''
+    Set of metrics, plus collectors called at scrape time to refresh
+    metrics that mirror other objects' state (e.g. cache counters).
+    '''
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def collector(self, fn):
+        self.collectors.append(fn)
+        return fn
+
+    def snapshot(self):
+        '''
+        Refreshes the collected metrics and returns every metric's values
+        in this process, JSON-serializable, for render() in another.
+        '''
+        for collect in self.collectors:
+            collect()
+        return dict((metric.name, metric.snapshot()) for metric in self.metrics)
+
+    def render(self, snapshots=None):
+        '''
+        Returns every metric in the Prometheus text exposition format.
+
+        By default these are this process's values. Given snapshots, a list
+        of (worker, snapshot()) pairs, they are every worker's: counters and
+        histograms are added up, and gauges are labelled by worker.
+        '''
+        lines = []
+        if snapshots is None:
+            for collect in self.collectors:
+                collect()
+            for metric in self.metrics:
+                lines.extend(metric.render())
+        else:
+            for metric in self.metrics:
+                lines.extend(metric.render(
+                    [(worker, snapshot.get(metric.name, []))
+                     for worker, snapshot in snapshots]))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# Valence calls, recorded by valence.py
+valence_seconds = REGISTRY.histogram('enrollments_valence_request_seconds',
+    'Latency of Valence API calls.', labels=('endpoint',))
+valence_responses = REGISTRY.counter('enrollments_valence_responses_total',
+    'Valence API responses by status code.', labels=('endpoint', 'status'))
+valence_retries = REGISTRY.counter('enrollments_valence_retries_total',
+    'Valence calls repeated, by endpoint and reason.',
+    labels=('endpoint', 'reason'))
+valence_pages = REGISTRY.histogram('enrollments_valence_pages',
+    'Pages fetched per paged Valence listing.', labels=('endpoint',),
+    buckets=(1, 2, 3, 5, 10, 20, 50))
+
+# outgoing mail, recorded by outbox.py
+mail_send_seconds = REGISTRY.histogram('enrollments_mail_send_seconds',
+    'Time to hand one message to the SMTP server.')
+mail_sent = REGISTRY.counter('enrollments_mail_messages_total',
+    'Outgoing mail by outcome.', labels=('outcome',))
@@ -0,0 +1,289 @@
+# enrollments/offerings.py
+#
+# Searchable index of a semester's course offerings, pulled from D2L in
+# bulk with the service account, behind the add class typeahead. Sync
+# semesters into the index shared by the app's workers from cron:
+#
+#     python offerings.py 0800 0805
+
+import argparse
+import bisect
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from courses import parse_codes
+
+
+# offerings returned by one search
+DEFAULT_LIMIT = 15
+
+_WORD = re.compile(r'[a-z0-9]+')
+
+
+def tokenize(text):
+    '''
+    Lower-case words of text, e.g. "CRIM JUS 110" -> crim, jus, 110.
+    '''
+    return _WORD.findall(text.lower())
+
+
+def code_filter(semCode, institution='UWOSH'):
+    '''
+    orgUnitCode filter matching every offering code of a semester.
+    '''
+    return '{0}_{1}_'.format(institution, semCode)
+
+
+#############
+# offerings #
+#############
+
+
+class Offering(object):
+    '''
+    A course offering in D2L: its org unit Identifier, Name and parsed
+    CourseCode.
+    '''
+
+    __slots__ = ('orgUnitId', 'name', 'code')
+
+    def __init__(self, orgUnitId, name, code):
+        self.orgUnitId = orgUnitId
+        self.name = name
+        self.code = code
+
+    def tokens(self):
+        code = self.code
+        subject = code.subject.lower()
+        words = tokenize(subject) + tokenize(self.name)
+        words.extend((subject.replace(' ', ''),
+                      subject.replace(' ', '') + code.catalogNumber,
+                      code.catalogNumber, code.section.lower(),
+                      'sec' + code.section.lower(), code.classNumber,
+                      code.sessionLength.lower()))
+        return words
+
+    def to_org_unit(self):
+        '''
+        The offering as lookup_org_unit returns it.
+        '''
+        return {'Identifier': self.orgUnitId, 'Name': self.name,
+                'Code': self.code.code}
+
+    def to_dict(self):
+        code = self.code
+        return {'id': self.orgUnitId,
+                'name': self.name,
+                'code': code.code,
+                'short': code.short,
+                'subject': code.subject,
+                'catalogNumber': code.catalogNumber,
+                'section': code.section,
+                'classNumber': code.classNumber,
+                'sessionLength': code.sessionLength}
+
+
+class SemesterOfferings(object):
+    '''
+    One semester's offerings, ordered by subject, catalog number and
+    section, with a sorted list of their words for prefix search.
+    '''
+
+    def __init__(self, semCode, rows, synced=None):
+        self.semCode = semCode
+        self.synced = time.time() if synced is None else synced
+        # rows are (Identifier, Name, Code); codes that are not UWOSH
+        # offerings of this semester are left out
+        codes = parse_codes([row[2] for row in rows])
+        offerings = [Offering(row[0], row[1], code)
+                     for row, code in zip(rows, codes)
+                     if code is not None and code.semCode == semCode]
+        offerings.sort(key=lambda o: (o.code.subject, o.code.catalogNumber,
+                                      o.code.section, o.code.code))
+        self.offerings = offerings
+        self.byCode = dict((o.code.code, o) for o in offerings)
+        # each offering's words, and every (word, position) pair in order
+        self._offeringWords = [tuple(set(o.tokens())) for o in offerings]
+        pairs = sorted((word, position)
+                       for position, words in enumerate(self._offeringWords)
+                       for word in words)
+        self._words = [word for word, position in pairs]
+        self._positions = [position for word, position in pairs]
+
+    def __len__(self):
+        return len(self.offerings)
+
+    def rows(self):
+        return [(o.orgUnitId, o.name, o.code.code) for o in self.offerings]
+
+    def _range(self, prefix):
+        # words are [a-z0-9], all of which sort before '{'
+        return (bisect.bisect_left(self._words, prefix),
+                bisect.bisect_left(self._words, prefix + '{'))
+
+    def search(self, query, limit=DEFAULT_LIMIT):
+        '''
+        Returns up to limit offerings with a word starting with each word
+        of query, e.g. "crim 11" or "CRIM JUS 110 091C".
+        '''
+        # walk the offerings matching the narrowest word in order, checking
+        # the other words against each until there are enough
+        ranges = sorted(((self._range(word), word)
+                         for word in set(tokenize(query))),
+                        key=lambda r: r[0][1] - r[0][0])
+        if not ranges:
+            return []
+        (lo, hi), word = ranges[0]
+        others = [other for bounds, other in ranges[1:]]
+        results = []
+        for position in sorted(set(self._positions[lo:hi])):
+            words = self._offeringWords[position]
+            if all(any(w.startswith(other) for w in words) for other in others):
+                results.append(self.offerings[position])
+                if len(results) == limit:
+                    break
+        return results
+
+
+class OfferingIndex(object):
+    '''
+    Course offerings by semester, kept in memory and refreshed every `ttl`
+    seconds. load(semCode) fetches a semester's offerings from D2L as dicts
+    with Identifier, Name and Code.
+
+    A semester that is missing or expired is read from the shared `store`
+    if another process has synced it, and otherwise loaded on a background
+    thread; an expired semester is still searched until the new one is
+    ready. A failed load is not tried again for `retry` seconds.
+    '''
+
+    def __init__(self, load, ttl=3600, store=None, retry=60, logger=None):
+        self.load = load
+        self.ttl = ttl
+        self.store = store
+        self.retry = retry
+        self.logger = logger
+        self.hits = 0
+        self.misses = 0
+        self._semesters = {}
+        self._syncing = set()
+        self._failed = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def semester(self, semCode):
+        '''
+        Returns the SemesterOfferings for semCode, or None while it is
+        first being loaded.
+        '''
+        entry = self._semesters.get(semCode)
+        if entry is not None and time.time() - entry.synced < self.ttl:
+            return entry
+        if self.store is not None:
+            shared = self.store.get(semCode)
+            if shared is not None:
+                entry = SemesterOfferings(semCode, shared['rows'],
+                                          synced=shared['synced'])
+                self._semesters[semCode] = entry
+                return entry
+        self._start(semCode)
+        return entry
+
+    def sync(self, semCode):
+        '''
+        Loads semCode's offerings from D2L now and returns them.
+        '''
+        entry = SemesterOfferings(semCode, [(o['Identifier'], o['Name'], o['Code'])
+                                            for o in self.load(semCode)])
+        if self.store is not None:
+            self.store.set(semCode, {'synced': entry.synced,
+                                     'rows': entry.rows()},
+                           self.ttl)
+        self._semesters[semCode] = entry
+        with self._lock:
+            self._failed.pop(semCode, None)
+        return entry
+
+    def failed(self, semCode):
+        '''
+        True if the last load of semCode failed and no other is running.
+        '''
+        with self._lock:
+            return semCode in self._failed and semCode not in self._syncing
+
+    def _start(self, semCode):
+        with self._lock:
+            if semCode in self._syncing or \
+                    time.time() - self._failed.get(semCode, 0) < self.retry:
+                return
+            self._syncing.add(semCode)
+        self._executor.submit(self._background_sync, semCode)
+
+    def _background_sync(self, semCode):
+        try:
+            self.sync(semCode)
+        except Exception as e:
+            with self._lock:
+                self._failed[semCode] = time.time()
+            if self.logger is not None:
+                self.logger.warning('Offering sync for %s failed: %r',
+                                    semCode, e)
+        finally:
+            with self._lock:
+                self._syncing.discard(semCode)
+
+    def search(self, semCode, query, limit=DEFAULT_LIMIT):
+        '''
+        Returns up to limit of semCode's offerings matching query, or None
+        while the semester is first being loaded or if loading it failed
+        (see failed()).
+        '''
+        entry = self.semester(semCode)
+        if entry is None:
+            return None
+        return entry.search(query, limit)
+
+    def find(self, semCode, code):
+        '''
+        Returns the Offering with the full course code, or None if it is
+        not in the semester's index (or the index is not loaded yet).
+        '''
+        entry = self.semester(semCode)
+        offering = entry.byCode.get(code) if entry is not None else None
+        if offering is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return offering
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Sync semesters' course offerings from D2L into the "
+                    "index shared by the app's workers.")
+    parser.add_argument('semCodes', nargs='+', metavar='semCode',
+                        help='four-digit semester code, e.g. 0800')
+    args = parser.parse_args(argv)
+
+    import views
+    if views.offeringStore is None:
+        parser.error('set OFFERING_INDEX_SQLITE_PATH so the app workers '
+                     'can see what this job syncs')
+    failed = 0
+    for semCode in args.semCodes:
+        started = time.time()
+        try:
+            entry = views.offeringIndex.sync(semCode)
+        except Exception as e:
+            sys.stderr.write('{0}: {1!r}\n'.format(semCode, e))
+            failed += 1
+            continue
+        print('{0}: {1} offerings in {2:.1f}s'.format(semCode, len(entry),
+                                                      time.time() - started))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,261 @@
+# enrollments/outbox.py
+
+import json
+import random
+import threading
+import time
+from flask_mail import Message
+import metrics
+from stores import SqliteConnections
+
+
+##########
+# outbox #
+##########
+
+
+class MailOutbox(object):
+    '''
+    Durable queue of outgoing mail in a local SQLite file.
+
+    Views enqueue messages and return; a background sender drains due
+    messages in batches over one SMTP connection per batch. A failed message
+    is retried with exponential backoff and, after `max_attempts`, is kept
+    with status 'dead' for the site administrator to look at.
+    '''
+
+    def __init__(self, path, batch_size=20, max_attempts=8, base_delay=30,
+                 max_delay=3600, interval=5, lease=300):
+        self.path = path
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.interval = interval
+        self.lease = lease
+        # extra periodic work for the sender thread, e.g. building digests
+        self.jobs = []
+        self._connection = SqliteConnections(path, isolation_level=None)
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+        with self._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS outbox ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'message TEXT NOT NULL, '
+                         'status TEXT NOT NULL, '
+                         'attempts INTEGER NOT NULL DEFAULT 0, '
+                         'next_attempt REAL NOT NULL, '
+                         'claimed_at REAL, '
+                         'last_error TEXT)')
+            conn.execute('CREATE INDEX IF NOT EXISTS outbox_due '
+                         'ON outbox (status, next_attempt)')
+
+    def enqueue(self, msg):
+        '''
+        Stores a flask_mail.Message for the sender to deliver.
+        '''
+        with self._connection() as conn:
+            self._insert(conn, msg)
+        self._wake.set()
+
+    def _insert(self, conn, msg):
+        fields = {'subject': msg.subject,
+                  'sender': msg.sender,
+                  'recipients': list(msg.recipients),
+                  'body': msg.body,
+                  'html': msg.html}
+        conn.execute('INSERT INTO outbox (message, status, next_attempt) '
+                     "VALUES (?, 'pending', ?)",
+                     (json.dumps(fields), time.time()))
+
+    def _claim(self):
+        # takes a batch of due messages so no other worker sends them too;
+        # claims older than the lease are assumed lost and taken back
+        now = time.time()
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute("UPDATE outbox SET status = 'pending' "
+                         "WHERE status = 'sending' AND claimed_at < ?",
+                         (now - self.lease,))
+            rows = conn.execute("SELECT id, message, attempts FROM outbox "
+                                "WHERE status = 'pending' AND next_attempt <= ? "
+                                "ORDER BY id LIMIT ?",
+                                (now, self.batch_size)).fetchall()
+            conn.executemany("UPDATE outbox SET status = 'sending', "
+                             "claimed_at = ? WHERE id = ?",
+                             [(now, row[0]) for row in rows])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return rows
+
+    def _sent(self, id):
+        with self._connection() as conn:
+            conn.execute('DELETE FROM outbox WHERE id = ?', (id,))
+
+    def _failed(self, id, attempts, error):
+        attempts += 1
+        if attempts >= self.max_attempts:
+            status, next_attempt = 'dead', time.time()
+        else:
+            delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+            status = 'pending'
+            next_attempt = time.time() + delay * random.uniform(0.5, 1.0)
+        with self._connection() as conn:
+            conn.execute('UPDATE outbox SET status = ?, attempts = ?, '
+                         'next_attempt = ?, claimed_at = NULL, last_error = ? '
+                         'WHERE id = ?',
+                         (status, attempts, next_attempt, repr(error), id))
+
+    def drain(self, mail):
+        '''
+        Sends every due message in batches. Must run in an app context.
+        Returns the number of messages sent.
+        '''
+        sent = 0
+        while True:
+            rows = self._claim()
+            if not rows:
+                return sent
+            done = set()
+            try:
+                with mail.connect() as smtp:
+                    for id, message, attempts in rows:
+                        start = time.time()
+                        try:
+                            smtp.send(Message(**json.loads(message)))
+                        except Exception as e:
+                            metrics.mail_sent.inc(outcome='failed')
+                            self._failed(id, attempts, e)
+                        else:
+                            metrics.mail_send_seconds.observe(time.time() - start)
+                            metrics.mail_sent.inc(outcome='sent')
+                            self._sent(id)
+                            sent += 1
+                        done.add(id)
+            except Exception as e:
+                # could not connect, or the connection dropped mid-batch
+                for id, message, attempts in rows:
+                    if id not in done:
+                        metrics.mail_sent.inc(outcome='failed')
+                        self._failed(id, attempts, e)
+                return sent
+
+    def start(self, app, mail):
+        '''
+        Starts the background sender thread for app, once per process.
+        '''
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, args=(app, mail))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        '''
+        Stops the sender thread after its current pass and waits for it.
+        Messages still queued stay in the outbox for the next start().
+        '''
+        thread = self._thread
+        if thread is None:
+            return
+        self._stopping = True
+        self._wake.set()
+        thread.join(timeout)
+        self._thread = None
+
+    def _run(self, app, mail):
+        while not self._stopping:
+            try:
+                with app.app_context():
+                    for job in self.jobs:
+                        job()
+                    self.drain(mail)
+            except Exception:
+                app.logger.exception('Mail outbox drain failed')
+            if self._stopping:
+                return
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def counts(self):
+        '''
+        Returns the number of queued messages by status.
+        '''
+        return dict(self._connection().execute(
+            'SELECT status, COUNT(*) FROM outbox GROUP BY status').fetchall())
+
+
+##########
+# digest #
+##########
+
+
+class AdminDigest(object):
+    '''
+    Notifications for the site administrator held back and sent as one
+    message once `batch_size` have built up or the oldest has waited
+    `interval` seconds.
+
+    Items are kept in the outbox's SQLite file, so every worker adds to the
+    same digest, and the digest message is queued in the same transaction
+    that takes its items. `build(items)` turns the items, oldest first,
+    into a flask_mail.Message; it runs on the outbox's sender thread inside
+    an app context.
+    '''
+
+    def __init__(self, outbox, build, interval=900, batch_size=50):
+        self.outbox = outbox
+        self.build = build
+        self.interval = interval
+        self.batch_size = batch_size
+        with outbox._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS digest ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'item TEXT NOT NULL, '
+                         'added REAL NOT NULL)')
+        outbox.jobs.append(self.flush)
+
+    def add(self, item):
+        '''
+        Holds a JSON-serializable item for the next digest.
+        '''
+        with self.outbox._connection() as conn:
+            conn.execute('INSERT INTO digest (item, added) VALUES (?, ?)',
+                         (json.dumps(item), time.time()))
+            count = conn.execute('SELECT COUNT(*) FROM digest').fetchone()[0]
+        if count >= self.batch_size:
+            self.outbox._wake.set()
+
+    def flush(self, force=False):
+        '''
+        Queues the digest if it is due, or if force is set and it is not
+        empty. Returns the number of items sent.
+        '''
+        conn = self.outbox._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            count, oldest = conn.execute(
+                'SELECT COUNT(*), MIN(added) FROM digest').fetchone()
+            if not count or not (force or count >= self.batch_size or
+                                 oldest <= time.time() - self.interval):
+                conn.execute('ROLLBACK')
+                return 0
+            rows = conn.execute(
+                'SELECT id, item FROM digest ORDER BY id').fetchall()
+            self.outbox._insert(conn,
+                                self.build([json.loads(row[1]) for row in rows]))
+            conn.execute('DELETE FROM digest WHERE id <= ?', (rows[-1][0],))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return len(rows)
+
+    def __len__(self):
+        return self.outbox._connection().execute(
+            'SELECT COUNT(*) FROM digest').fetchone()[0]
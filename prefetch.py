@@ -0,0 +1,88 @@
+# enrollments/prefetch.py
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+############
+# prefetch #
+############
+
+
+class Prefetcher(object):
+    '''
+    Starts work for a key in the background so a later request can pick up
+    the result. Results that are never collected are dropped after `expire`
+    seconds.
+
+    With a `shared` store (see stores.py) work in flight is recorded there,
+    so a worker process asked for a key another process is already working
+    on waits for that work to finish before running its own, which then
+    finds the other's result in the shared cache. A record is held for at
+    most `lease` seconds, in case its process dies.
+    '''
+
+    def __init__(self, max_workers=4, expire=600, shared=None, lease=120,
+                 poll=0.25):
+        self.expire = expire
+        self.shared = shared
+        self.lease = lease
+        self.poll = poll
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def start(self, key, fn):
+        '''
+        Runs fn() in the background for key unless it is already running,
+        and returns the future of the work for key.
+        '''
+        now = time.time()
+        with self._lock:
+            for stale in [k for k, (f, started) in self._futures.items()
+                          if now - started > self.expire]:
+                del self._futures[stale]
+            if key not in self._futures:
+                self._futures[key] = (self._executor.submit(self._run, key, fn),
+                                      now)
+            return self._futures[key][0]
+
+    def _run(self, key, fn):
+        if self.shared is None:
+            return fn()
+        # another process holding the key is doing the same work; wait for
+        # it rather than going to D2L a second time
+        while not self.shared.add(str(key), {'pid': os.getpid()}, self.lease):
+            time.sleep(self.poll)
+        try:
+            return fn()
+        finally:
+            self.shared.delete(str(key))
+
+    def running(self, key):
+        '''
+        True while the work started for key, in this process or any other
+        sharing the store, has not finished.
+        '''
+        with self._lock:
+            item = self._futures.get(key)
+        if item is not None:
+            return not item[0].done()
+        return self.shared is not None and self.shared.get(str(key)) is not None
+
+    def result(self, key, fallback, timeout=None):
+        '''
+        Returns the result of the work started for key, waiting at most
+        timeout seconds (raising concurrent.futures.TimeoutError after that).
+        If nothing was started for key in this process, starts fallback() in
+        the background and waits for that the same way.
+        '''
+        future = self.start(key, fallback)
+        try:
+            return future.result(timeout=timeout)
+        finally:
+            if future.done():
+                with self._lock:
+                    self._futures.pop(key, None)
@@ -0,0 +1,39 @@
+# enrollments/resources.py
+
+import os
+import threading
+
+
+#############
+# resources #
+#############
+
+
+class ProcessLocal(object):
+    '''
+    Stands in for an object holding connections, files or threads, which
+    cannot be shared across a fork. The object is built by factory() the
+    first time it is used in each process, so importing the app opens
+    nothing and every worker, including one started to replace another,
+    builds its own on demand.
+
+    Attribute access is passed through to the object; resolve() returns it.
+    '''
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._pid = None
+        self._obj = None
+
+    def resolve(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._obj = self._factory()
+                    self._pid = pid
+        return self._obj
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
@@ -1,4 +1,6 @@
 # run.py
+#
+# Development server. In production serve wsgi:application with gunicorn.conf.py.
 
-from views import app
-app.run(debug=True)
\ No newline at end of file
+from views import create_app
+create_app(debug=True).run(debug=True)
@@ -0,0 +1,109 @@
+# enrollments/sessions.py
+
+import os
+import binascii
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import Signer, BadSignature
+from werkzeug.datastructures import CallbackDict
+from stores import MemoryStore, SqliteStore
+from resources import ProcessLocal
+
+
+############
+# sessions #
+############
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    '''
+    Session whose contents live in a server-side store; the browser only
+    holds the session id.
+    '''
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+class ServerSideSessionInterface(SessionInterface):
+    '''
+    Keeps session data in `store` and only an opaque, signed session id in
+    the session cookie.
+
+    Nested changes (e.g. to a list inside the session) are not seen by the
+    session, so views that make them must set `session.modified = True`.
+    '''
+
+    session_class = ServerSideSession
+
+    def __init__(self, store):
+        self.store = store
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt='enrollments-session')
+
+    def _new_sid(self):
+        return binascii.hexlify(os.urandom(20)).decode('ascii')
+
+    def regenerate(self, session):
+        '''
+        Moves session to a new session id and drops the old one from the
+        store, so an id planted before login is worthless after it.
+        '''
+        self.store.delete(session.sid)
+        session.sid = self._new_sid()
+        session.modified = True
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(app.session_cookie_name)
+        if cookie:
+            try:
+                sid = self._signer(app).unsign(cookie).decode('ascii')
+            except BadSignature:
+                sid = None
+            if sid:
+                data = self.store.get(sid)
+                if data is not None:
+                    return self.session_class(data, sid=sid)
+        return self.session_class(sid=self._new_sid(), new=True)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified:
+                self.store.delete(session.sid)
+                response.delete_cookie(app.session_cookie_name,
+                                       domain=domain, path=path)
+            return
+        if not session.modified:
+            return
+        lifetime = app.permanent_session_lifetime
+        ttl = lifetime.days * 86400 + lifetime.seconds
+        self.store.set(session.sid, dict(session), ttl)
+        cookie = self._signer(app).sign(session.sid.encode('ascii'))
+        response.set_cookie(app.session_cookie_name, cookie,
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            secure=self.get_cookie_secure(app),
+                            domain=domain, path=path)
+
+
+def session_interface_from_config(config):
+    '''
+    Builds the session interface named by SESSION_BACKEND, or None to keep
+    Flask's signed-cookie sessions.
+    '''
+    backend = config.get('SESSION_BACKEND', 'cookie')
+    if backend == 'memory':
+        return ServerSideSessionInterface(MemoryStore())
+    if backend == 'sqlite':
+        return ServerSideSessionInterface(ProcessLocal(
+            lambda: SqliteStore(config['SESSION_SQLITE_PATH'], table='sessions')))
+    if backend == 'cookie':
+        return None
+    raise ValueError('Unknown SESSION_BACKEND: {0}'.format(backend))
@@ -0,0 +1,195 @@
+# enrollments/stores.py
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+
+############
+# encoding #
+############
+
+
+def encode(value):
+    '''
+    Packs a JSON-serializable value into compact zlib-compressed JSON bytes.
+    '''
+    return zlib.compress(json.dumps(value, separators=(',', ':')).encode('utf-8'))
+
+
+def decode(payload):
+    '''
+    Unpacks a value packed by encode().
+    '''
+    return json.loads(zlib.decompress(payload).decode('utf-8'))
+
+
+###############
+# connections #
+###############
+
+
+class SqliteConnections(object):
+    '''
+    Opens a SQLite file in WAL mode, creating its directory, with one
+    connection per thread; calling the object returns the calling thread's
+    connection. Keyword arguments are passed to sqlite3.connect.
+    '''
+
+    def __init__(self, path, **kwargs):
+        self.path = path
+        self.kwargs = kwargs
+        kwargs.setdefault('timeout', 10)
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __call__(self):
+        # sqlite connections cannot be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, **self.kwargs)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+
+##########
+# stores #
+##########
+
+
+class MemoryStore(object):
+    '''
+    Expiring key/value store held in this process's memory.
+    '''
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            payload, expires = item
+            if expires < time.time():
+                del self._data[key]
+                return None
+            return decode(payload)
+
+    def set(self, key, value, ttl):
+        payload = encode(value)
+        with self._lock:
+            self._data[key] = (payload, time.time() + ttl)
+
+    def add(self, key, value, ttl):
+        '''
+        Sets key only if it holds no live entry. Returns True if it was set.
+        '''
+        payload = encode(value)
+        now = time.time()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[1] >= now:
+                return False
+            self._data[key] = (payload, now + ttl)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def items(self):
+        '''
+        Returns (key, value) for every live entry.
+        '''
+        now = time.time()
+        with self._lock:
+            live = [(k, p) for k, (p, expires) in self._data.items()
+                    if expires >= now]
+        return [(k, decode(p)) for k, p in live]
+
+    def purge(self):
+        '''
+        Drops every expired entry.
+        '''
+        now = time.time()
+        with self._lock:
+            for key in [k for k, (p, expires) in self._data.items()
+                        if expires < now]:
+                del self._data[key]
+
+
+class SqliteStore(object):
+    '''
+    Expiring key/value store in a local SQLite file, shared by every worker
+    process on the host.
+    '''
+
+    def __init__(self, path, table='store'):
+        self.path = path
+        self.table = table
+        self._connection = SqliteConnections(path)
+        with self._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS {0} ('
+                         'key TEXT PRIMARY KEY, '
+                         'payload BLOB NOT NULL, '
+                         'expires REAL NOT NULL)'.format(self.table))
+            conn.execute('CREATE INDEX IF NOT EXISTS {0}_expires '
+                         'ON {0} (expires)'.format(self.table))
+
+    def get(self, key):
+        row = self._connection().execute(
+            'SELECT payload, expires FROM {0} WHERE key = ?'.format(self.table),
+            (key,)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return decode(bytes(row[0]))
+
+    def set(self, key, value, ttl):
+        with self._connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO {0} (key, payload, expires) '
+                         'VALUES (?, ?, ?)'.format(self.table),
+                         (key, sqlite3.Binary(encode(value)), time.time() + ttl))
+
+    def add(self, key, value, ttl):
+        '''
+        Sets key only if it holds no live entry, atomically across
+        processes. Returns True if it was set.
+        '''
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute('DELETE FROM {0} WHERE key = ? AND expires < ?'.format(
+                self.table), (key, now))
+            cursor = conn.execute('INSERT OR IGNORE INTO {0} (key, payload, '
+                                  'expires) VALUES (?, ?, ?)'.format(self.table),
+                                  (key, sqlite3.Binary(encode(value)), now + ttl))
+        return cursor.rowcount == 1
+
+    def delete(self, key):
+        with self._connection() as conn:
+            conn.execute('DELETE FROM {0} WHERE key = ?'.format(self.table),
+                         (key,))
+
+    def items(self):
+        '''
+        Returns (key, value) for every live entry.
+        '''
+        rows = self._connection().execute(
+            'SELECT key, payload FROM {0} WHERE expires >= ?'.format(self.table),
+            (time.time(),)).fetchall()
+        return [(row[0], decode(bytes(row[1]))) for row in rows]
+
+    def purge(self):
+        '''
+        Drops every expired entry.
+        '''
+        with self._connection() as conn:
+            conn.execute('DELETE FROM {0} WHERE expires < ?'.format(self.table),
+                         (time.time(),))
@@ -0,0 +1,414 @@
+# enrollments/valence.py
+
+import random
+import re
+import threading
+import time
+import requests
+import auth2 as d2lauth
+import metrics
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from requests.compat import cookielib
+
+
+# default (connect, read) timeouts in seconds for calls to the LMS
+DEFAULT_TIMEOUT = (3.05, 15)
+
+# default number of keep-alive connections kept open per LMS host
+DEFAULT_POOL_SIZE = 10
+
+# default number of Valence calls one process keeps in flight at once
+DEFAULT_CONCURRENCY = 8
+
+# default retries of a failed GET, and the backoff before them in seconds
+DEFAULT_RETRIES = 2
+DEFAULT_BACKOFF = 0.25
+DEFAULT_BACKOFF_MAX = 4.0
+
+# default consecutive failures that open the circuit breaker, and seconds it
+# stays open before letting a trial call through
+DEFAULT_BREAKER_THRESHOLD = 5
+DEFAULT_BREAKER_RESET = 30
+
+# gateway errors worth retrying; anything else is D2L's considered answer
+RETRY_STATUSES = frozenset([502, 503, 504])
+
+# path segments that identify a user or org unit rather than an endpoint
+_ID_SEGMENT = re.compile(r'/\d+(?=/|$)')
+
+
+##########
+# errors #
+##########
+
+
+class ValenceUnavailable(requests.ConnectionError):
+    '''
+    Raised without calling D2L while the circuit breaker is open, and when
+    D2L still answers with a gateway error once retries run out.
+    '''
+
+
+class CircuitBreaker(object):
+    '''
+    Fails calls fast after `threshold` consecutive failures. After `reset`
+    seconds one trial call is let through; if it works the breaker closes,
+    otherwise it stays open for another `reset` seconds.
+    '''
+
+    def __init__(self, threshold=DEFAULT_BREAKER_THRESHOLD,
+                 reset=DEFAULT_BREAKER_RESET):
+        self.threshold = threshold
+        self.reset = reset
+        self.failures = 0
+        self.opened = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened is not None
+
+    def before(self):
+        '''
+        Raises ValenceUnavailable unless a call may go ahead now.
+        '''
+        with self._lock:
+            if self.opened is None:
+                return
+            if self._trial or time.time() - self.opened < self.reset:
+                raise ValenceUnavailable('D2L is not responding')
+            self._trial = True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.failures >= self.threshold:
+                self.opened = time.time()
+
+
+###########
+# clients #
+###########
+
+
+class ValenceClient(object):
+    '''
+    Pooled, keep-alive HTTP client for Valence API calls against a single LMS
+    host. A single instance is safe to share between request threads.
+
+    GETs that fail to connect, time out or meet a gateway error are retried
+    up to `retries` times with jittered exponential backoff. Consecutive
+    failures open a circuit breaker shared by every call to the host.
+    '''
+
+    def __init__(self, host, encrypt_requests=True, pool_size=DEFAULT_POOL_SIZE,
+                 timeout=DEFAULT_TIMEOUT, verify=True, retries=DEFAULT_RETRIES,
+                 backoff=DEFAULT_BACKOFF, backoff_max=DEFAULT_BACKOFF_MAX,
+                 breaker=None):
+        self.host = host
+        self.scheme = 'https' if encrypt_requests else 'http'
+        self.timeout = timeout
+        self.verify = verify
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        self.session = self._new_session()
+
+    def _new_session(self):
+        session = requests.Session()
+        # every user's calls share this session, so a cookie D2L sets for
+        # one of them must not be kept and sent with everyone else's
+        session.cookies.set_policy(cookielib.DefaultCookiePolicy(
+            allowed_domains=[]))
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.pool_size,
+                              pool_block=False)
+        session.mount(self.scheme + '://', adapter)
+        return session
+
+    def get(self, uc, route, **kwargs):
+        '''
+        Signs route with the user context and issues a GET over the pool.
+
+        A 403 caused by clock skew calibrates the user context from the
+        server's time and is retried once, re-signed. Raises
+        ValenceUnavailable while the circuit breaker is open or when D2L
+        still answers with a gateway error once retries run out, and the
+        last connection error or timeout once retries run out.
+        '''
+        endpoint = endpoint_name(route)
+        attempt = 0
+        calibrated = False
+        while True:
+            url = uc.create_authenticated_url(route)
+            self.breaker.before()
+            try:
+                r = self._send(url, endpoint, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.breaker.failure()
+                if attempt >= self.retries:
+                    raise
+                reason = type(e).__name__
+            except Exception:
+                self.breaker.failure()
+                raise
+            else:
+                if r.status_code not in RETRY_STATUSES:
+                    self.breaker.success()
+                    if (r.status_code == 403 and not calibrated and
+                            uc.interpret_result(r.status_code, r) ==
+                            d2lauth.D2LAuthResult.INVALID_TIMESTAMP):
+                        calibrated = True
+                        metrics.valence_retries.inc(endpoint=endpoint,
+                                                    reason='skew')
+                        continue
+                    return r
+                self.breaker.failure()
+                r.close()
+                if attempt >= self.retries:
+                    raise ValenceUnavailable(
+                        'D2L answered {0} to {1}'.format(r.status_code, endpoint),
+                        response=r)
+                reason = str(r.status_code)
+            attempt += 1
+            metrics.valence_retries.inc(endpoint=endpoint, reason=reason)
+            time.sleep(self._backoff(attempt))
+
+    def _backoff(self, attempt):
+        # "full jitter": a uniform wait up to the exponential cap, so retries
+        # from many workers after one outage do not arrive together
+        return random.uniform(0, min(self.backoff_max,
+                                     self.backoff * 2 ** (attempt - 1)))
+
+    def _send(self, url, endpoint, **kwargs):
+        start = time.time()
+        try:
+            r = self.get_url(url, **kwargs)
+        except requests.RequestException as e:
+            metrics.valence_responses.inc(endpoint=endpoint,
+                                          status=type(e).__name__)
+            raise
+        finally:
+            metrics.valence_seconds.observe(time.time() - start,
+                                            endpoint=endpoint)
+        metrics.valence_responses.inc(endpoint=endpoint, status=r.status_code)
+        return r
+
+    def get_url(self, url, **kwargs):
+        '''
+        Issues a GET for an already-signed url over the pool.
+        '''
+        kwargs.setdefault('timeout', self.timeout)
+        kwargs.setdefault('verify', self.verify)
+        return self.session.get(url, **kwargs)
+
+    def warm_up(self, connections=1):
+        '''
+        Opens connections to the LMS ahead of the first login so the TCP and
+        TLS handshakes are not paid on a user's request.
+        '''
+        url = '{0}://{1}/d2l/api/versions/'.format(self.scheme, self.host)
+        threads = [threading.Thread(target=self._touch, args=(url,))
+                   for i in range(connections)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _touch(self, url):
+        try:
+            self.session.head(url, timeout=self.timeout, verify=self.verify)
+        except requests.RequestException:
+            # warm-up is best effort; the first real call will reconnect
+            pass
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncValence(object):
+    '''
+    Runs Valence calls on a bounded pool of workers so a single process can
+    keep many users' logins in flight at once while making at most
+    `max_workers` calls to D2L. Every method returns a
+    concurrent.futures.Future; signing is left to the user context passed in.
+
+    A call made on the pool must not wait on another submitted to it.
+    '''
+
+    def __init__(self, client, ver, max_workers=DEFAULT_CONCURRENCY):
+        self.client = client
+        self.ver = ver
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def submit(self, fn, *args, **kwargs):
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def whoami(self, uc):
+        '''
+        Future of the whoami record for the user context.
+        '''
+        return self.submit(self._whoami, uc)
+
+    def enrollments(self, uc, userId, build, roleId=None, orgUnitTypeId=None):
+        '''
+        Future of build(pages), where pages yields the Id/Name/Code records
+        of each of the user's enrollment pages as it arrives.
+        '''
+        return self.submit(lambda: build(iter_enrollment_pages(self.client,
+            uc, self.ver, userId, roleId=roleId, orgUnitTypeId=orgUnitTypeId)))
+
+    def orgstructure(self, uc, orgUnitCode, orgUnitType=None):
+        '''
+        Future of the first org unit matching orgUnitCode, or False.
+        '''
+        return self.submit(lookup_org_unit, self.client, uc, self.ver,
+            orgUnitCode, orgUnitType)
+
+    def _whoami(self, uc):
+        r = self.client.get(uc, '/d2l/api/lp/{0}/users/whoami'.format(self.ver))
+        r.raise_for_status()
+        return r.json()
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+##########
+# pagers #
+##########
+
+
+def iter_enrollment_pages(client, uc, ver, userId, roleId=None,
+                          orgUnitTypeId=None):
+    '''
+    Yields the list of Id, Name and Code records on each page of the org
+    units a user is enrolled in, following bookmarks one page at a time.
+    Each page is parsed once.
+    '''
+    route = '/d2l/api/lp/{0}/enrollments/users/{1}/orgUnits/'.format(ver, userId)
+    params = {}
+    if roleId is not None:
+        params['roleId'] = roleId
+    if orgUnitTypeId is not None:
+        params['orgUnitTypeId'] = orgUnitTypeId
+    pages = 0
+    while True:
+        r = client.get(uc, route, params=params)
+        r.raise_for_status()
+        page = r.json()
+        pages += 1
+        yield [{'Id': item['OrgUnit']['Id'],
+                'Name': item['OrgUnit']['Name'],
+                'Code': item['OrgUnit']['Code']} for item in page['Items']]
+        pagingInfo = page['PagingInfo']
+        if not pagingInfo['HasMoreItems']:
+            break
+        params['bookmark'] = pagingInfo['Bookmark']
+    metrics.valence_pages.observe(pages, endpoint=endpoint_name(route))
+
+
+def iter_org_unit_users(client, uc, ver, orgUnitId, roleId=None):
+    '''
+    Yields the D2L Identifier of each user enrolled in an org unit,
+    following bookmarks one page at a time.
+    '''
+    route = '/d2l/api/lp/{0}/enrollments/orgUnits/{1}/users/'.format(ver, orgUnitId)
+    params = {}
+    if roleId is not None:
+        params['roleId'] = roleId
+    pages = 0
+    while True:
+        r = client.get(uc, route, params=params)
+        r.raise_for_status()
+        page = r.json()
+        pages += 1
+        for item in page['Items']:
+            yield item['User']['Identifier']
+        pagingInfo = page['PagingInfo']
+        if not pagingInfo['HasMoreItems']:
+            break
+        params['bookmark'] = pagingInfo['Bookmark']
+    metrics.valence_pages.observe(pages, endpoint=endpoint_name(route))
+
+
+def iter_org_units(client, uc, ver, orgUnitType=None, orgUnitCode=None):
+    '''
+    Yields the Identifier, Name and Code of each org unit in the org
+    structure, following bookmarks one page at a time. D2L matches
+    orgUnitCode anywhere in the code, so a prefix lists a whole semester.
+    '''
+    route = '/d2l/api/lp/{0}/orgstructure/'.format(ver)
+    params = {}
+    if orgUnitType is not None:
+        params['orgUnitType'] = orgUnitType
+    if orgUnitCode is not None:
+        params['orgUnitCode'] = orgUnitCode
+    pages = 0
+    while True:
+        r = client.get(uc, route, params=params)
+        r.raise_for_status()
+        page = r.json()
+        pages += 1
+        for item in page['Items']:
+            yield {'Identifier': item['Identifier'],
+                   'Name': item['Name'],
+                   'Code': item['Code']}
+        pagingInfo = page['PagingInfo']
+        if not pagingInfo['HasMoreItems']:
+            break
+        params['bookmark'] = pagingInfo['Bookmark']
+    metrics.valence_pages.observe(pages, endpoint=endpoint_name(route))
+
+
+def lookup_org_unit(client, uc, ver, orgUnitCode, orgUnitType=None):
+    '''
+    Returns the first org unit whose code matches orgUnitCode, or False.
+    '''
+    params = {'orgUnitCode': orgUnitCode}
+    if orgUnitType is not None:
+        params['orgUnitType'] = orgUnitType
+    r = client.get(uc, '/d2l/api/lp/{0}/orgstructure/'.format(ver),
+        params=params)
+    r.raise_for_status()
+    try:
+        return r.json()['Items'][0]
+    except IndexError:
+        return False
+
+
+def endpoint_name(route):
+    '''
+    Returns route with user and org unit ids replaced, for use as a metric
+    label, e.g. /d2l/api/lp/1.4/enrollments/users/{id}/orgUnits/.
+    '''
+    return _ID_SEGMENT.sub('/{id}', route)
+
+
+def client_from_config(config):
+    '''
+    Builds a client for the LMS host named in the app config. Share it
+    within a process; each process needs its own (see resources.py).
+    '''
+    return ValenceClient(config['LMS_HOST'],
+        encrypt_requests=config['ENCRYPT_REQUESTS'],
+        pool_size=config.get('VALENCE_POOL_SIZE', DEFAULT_POOL_SIZE),
+        timeout=config.get('VALENCE_TIMEOUT', DEFAULT_TIMEOUT),
+        retries=config.get('VALENCE_RETRIES', DEFAULT_RETRIES),
+        backoff=config.get('VALENCE_BACKOFF', DEFAULT_BACKOFF),
+        backoff_max=config.get('VALENCE_BACKOFF_MAX', DEFAULT_BACKOFF_MAX),
+        breaker=CircuitBreaker(
+            threshold=config.get('VALENCE_BREAKER_THRESHOLD',
+                                 DEFAULT_BREAKER_THRESHOLD),
+            reset=config.get('VALENCE_BREAKER_RESET', DEFAULT_BREAKER_RESET)))
@@ -1,13 +1,30 @@
 # enrollments/views.py
 
-from flask import Flask, render_template, request, session, flash, redirect, url_for
+from flask import Flask, render_template, request, session, flash, redirect, url_for, jsonify, Markup, Response, g, abort
+from jinja2 import FileSystemBytecodeCache
 from flask_mail import Mail, Message
 from flask_wtf.csrf import CsrfProtect
 from functools import wraps
-from form import SelectSemesterForm, SelectCoursesForm, AdditionalCourseForm
-import requests
+from concurrent.futures import Future, TimeoutError
+from form import SelectSemesterForm, SelectCoursesForm, AdditionalCourseForm, BulkCourseForm, parse_class_rows
+import hmac
 import os
+import threading
+import time
+import requests
 import auth2 as d2lauth
+import metrics
+import valence
+from cache import EnrollmentCache, UserContextCache, LookupCache, LRUCache
+from sessions import session_interface_from_config
+from stores import SqliteStore
+from resources import ProcessLocal
+from prefetch import Prefetcher
+from courses import CourseIndex, parse_code, parse_course_code, parse_codes, make_code
+from outbox import MailOutbox, AdminDigest
+from ledger import Ledger
+from offerings import OfferingIndex, code_filter
+import export
 
 
 ##########
@@ -16,14 +33,278 @@ import auth2 as d2lauth
 
 
 app = Flask(__name__)
-app.config.from_pyfile('app_config.cfg')
+app.config.from_pyfile(os.environ.get('ENROLLMENTS_SETTINGS', 'app_config.cfg'))
 mail = Mail(app)
-app.secret_key = os.urandom(24)
 CsrfProtect(app)
 
+# SECRET_KEY values from the settings templates, which are public
+PLACEHOLDER_SECRET_KEYS = ('change me', 'a long random string')
+
+sessionInterface = session_interface_from_config(app.config)
+if sessionInterface is not None:
+    app.session_interface = sessionInterface
+
+# choice lists and rendered course fields, per state of a course list
+renderCache = LRUCache(app.config.get('RENDER_CACHE_SIZE', 2000))
+
 appContext = d2lauth.fashion_app_context(app_id=app.config['APP_ID'],
                                          app_key=app.config['APP_KEY'])
 
+userContexts = UserContextCache(appContext,
+    max_entries=app.config.get('USER_CONTEXT_CACHE_SIZE', 5000))
+
+courseLookups = LookupCache(
+    ttl=app.config.get('LOOKUP_CACHE_TTL', 3600),
+    negative_ttl=app.config.get('LOOKUP_CACHE_NEGATIVE_TTL', 300),
+    max_entries=app.config.get('LOOKUP_CACHE_MAX_ENTRIES', 10000))
+
+
+#############
+# resources #
+#############
+
+
+# connections, files and threads cannot cross a fork, so each process builds
+# its own on first use; importing the app opens none of them
+valenceClient = ProcessLocal(lambda: valence.client_from_config(app.config))
+
+valenceWorkers = ProcessLocal(lambda: valence.AsyncValence(valenceClient.resolve(),
+    app.config['VER'],
+    max_workers=app.config.get('VALENCE_CONCURRENCY', valence.DEFAULT_CONCURRENCY)))
+
+# with a shared enrollment cache, a fetch running in one worker is recorded
+# next to it so the worker that takes the semester form waits on that fetch
+enrollmentPrefetch = ProcessLocal(lambda: Prefetcher(
+    max_workers=app.config.get('PREFETCH_WORKERS', 4),
+    shared=SqliteStore(app.config['ENROLLMENT_CACHE_SQLITE_PATH'], table='prefetch')
+        if app.config.get('ENROLLMENT_CACHE_SQLITE_PATH') else None))
+
+# course lists shared by every worker and the warm-up job, if configured
+enrollmentStore = None
+if app.config.get('ENROLLMENT_CACHE_SQLITE_PATH'):
+    enrollmentStore = ProcessLocal(lambda: SqliteStore(
+        app.config['ENROLLMENT_CACHE_SQLITE_PATH'], table='enrollments'))
+
+enrollmentCache = EnrollmentCache(
+    ttl=app.config.get('ENROLLMENT_CACHE_TTL', 900),
+    stale=app.config.get('ENROLLMENT_CACHE_STALE', 3600),
+    budget=app.config.get('ENROLLMENT_CACHE_BUDGET', 2.0),
+    max_entries=app.config.get('ENROLLMENT_CACHE_MAX_ENTRIES', 2000),
+    max_bytes=app.config.get('ENROLLMENT_CACHE_MAX_BYTES', 64 * 1024 * 1024),
+    shared=enrollmentStore)
+
+mailOutbox = ProcessLocal(lambda: MailOutbox(
+    app.config.get('MAIL_OUTBOX_PATH', 'var/outbox.db'),
+    batch_size=app.config.get('MAIL_OUTBOX_BATCH', 20),
+    max_attempts=app.config.get('MAIL_OUTBOX_MAX_ATTEMPTS', 8),
+    interval=app.config.get('MAIL_OUTBOX_INTERVAL', 5)))
+
+# each semester's course offerings, searched by the add class typeahead and
+# shared with other workers and the sync job through offeringStore
+offeringStore = None
+if app.config.get('OFFERING_INDEX_SQLITE_PATH'):
+    offeringStore = ProcessLocal(lambda: SqliteStore(
+        app.config['OFFERING_INDEX_SQLITE_PATH'], table='offerings'))
+
+offeringIndex = ProcessLocal(lambda: OfferingIndex(
+    lambda semCode: load_offerings(semCode),
+    ttl=app.config.get('OFFERING_INDEX_TTL', 3600),
+    store=offeringStore, logger=app.logger))
+
+# each worker's metrics, published here so a scrape answered by any worker
+# reports all of them
+metricsStore = None
+if app.config.get('METRICS_SQLITE_PATH'):
+    metricsStore = ProcessLocal(lambda: SqliteStore(
+        app.config['METRICS_SQLITE_PATH'], table='metrics'))
+
+# every confirmed combine request, for lookups, dedupe and exports
+ledger = ProcessLocal(lambda: Ledger(app.config.get('LEDGER_PATH', 'var/ledger.db')))
+
+# combine requests for the site administrator, sent as one digest
+adminDigest = None
+if app.config.get('ADMIN_DIGEST'):
+    adminDigest = ProcessLocal(lambda: AdminDigest(mailOutbox.resolve(), build_digest,
+        interval=app.config.get('ADMIN_DIGEST_INTERVAL', 900),
+        batch_size=app.config.get('ADMIN_DIGEST_BATCH', 50)))
+
+
+###########
+# workers #
+###########
+
+
+_workerPid = None
+_workerLock = threading.Lock()
+_created = False
+_lastPurge = 0
+_lastPublish = 0
+
+
+def purge_stores():
+    '''
+    Drops expired sessions, cached course lists, offering indexes and
+    prefetch records, at most once every STORE_PURGE_INTERVAL seconds.
+    Runs on the mail sender thread, so a worker purges when it starts and
+    then periodically.
+    '''
+    global _lastPurge
+    now = time.time()
+    if now - _lastPurge < app.config.get('STORE_PURGE_INTERVAL', 600):
+        return
+    _lastPurge = now
+    stores = [enrollmentStore, offeringStore, enrollmentPrefetch.shared,
+              metricsStore]
+    if sessionInterface is not None:
+        stores.append(sessionInterface.store)
+    for store in stores:
+        if store is not None:
+            store.purge()
+
+
+def publish_metrics(force=False):
+    '''
+    Writes this process's metrics to metricsStore, at most once every
+    METRICS_PUBLISH_INTERVAL seconds unless force is set. A worker that
+    stops publishing drops out of the scrape after four intervals.
+    '''
+    global _lastPublish
+    interval = app.config.get('METRICS_PUBLISH_INTERVAL', 15)
+    now = time.time()
+    if not force and now - _lastPublish < interval:
+        return
+    _lastPublish = now
+    metricsStore.set(str(os.getpid()), metrics.REGISTRY.snapshot(),
+                     4 * interval)
+
+
+def start_worker():
+    '''
+    Starts this process's background work: the mail sender, which also
+    purges expired entries from the stores and publishes metrics, and, if configured, warm LMS
+    connections. Safe to call more than once.
+    '''
+    global _workerPid
+    with _workerLock:
+        pid = os.getpid()
+        if _workerPid == pid:
+            return
+        if adminDigest is not None:
+            # hands the digest's flush to this process's sender thread
+            adminDigest.resolve()
+        mailOutbox.jobs.append(purge_stores)
+        if metricsStore is not None:
+            mailOutbox.jobs.append(publish_metrics)
+        mailOutbox.start(app, mail)
+        if app.config.get('VALENCE_WARM_UP'):
+            valenceClient.warm_up(app.config['VALENCE_WARM_UP'])
+        _workerPid = pid
+
+
+def create_app(debug=False):
+    '''
+    Returns the app for a WSGI server, compiling its templates the first
+    time. Outside debug mode SECRET_KEY must be set, to a value of its own,
+    so that sessions signed by one worker are accepted by the others; the
+    development server falls back to a random key.
+
+    A server that preloads the app calls this once, so its workers share
+    the compiled templates copy-on-write and only build their own
+    connections and threads.
+    '''
+    global _created
+    secretKey = app.config.get('SECRET_KEY')
+    if not secretKey or secretKey in PLACEHOLDER_SECRET_KEYS:
+        if not debug:
+            raise RuntimeError('SECRET_KEY must be set in the settings file, '
+                               'to a long random string of your own, to '
+                               'serve the app from several workers')
+        app.secret_key = os.urandom(24)
+    with _workerLock:
+        if not _created:
+            # compiled templates are shared between workers and restarts on disk
+            jinjaCacheDir = app.config.get('JINJA_CACHE_DIR', 'var/jinja')
+            if not os.path.isdir(jinjaCacheDir):
+                os.makedirs(jinjaCacheDir)
+            app.jinja_env.bytecode_cache = FileSystemBytecodeCache(jinjaCacheDir)
+            precompile_templates()
+            _created = True
+    return app
+
+
+@app.before_request
+def ensure_worker():
+    if _workerPid != os.getpid():
+        start_worker()
+
+
+###########
+# metrics #
+###########
+
+
+requestSeconds = metrics.REGISTRY.histogram('enrollments_request_seconds',
+    'Time to handle a request, by route.', labels=('endpoint',))
+requestStatus = metrics.REGISTRY.counter('enrollments_responses_total',
+    'Responses by route and status code.', labels=('endpoint', 'status'))
+requestsInFlight = metrics.REGISTRY.gauge('enrollments_requests_in_flight',
+    'Requests being handled by this process.')
+cacheRequests = metrics.REGISTRY.gauge('enrollments_cache_requests',
+    'Cache lookups by cache and result since the process started.',
+    labels=('cache', 'result'))
+cacheHitRatio = metrics.REGISTRY.gauge('enrollments_cache_hit_ratio',
+    'Share of cache lookups answered without going to D2L.',
+    labels=('cache',))
+outboxMessages = metrics.REGISTRY.gauge('enrollments_mail_outbox_messages',
+    'Messages waiting in the mail outbox, by status.', labels=('status',))
+breakerOpen = metrics.REGISTRY.gauge('enrollments_valence_breaker_open',
+    '1 while calls to D2L are failing fast.')
+
+
+@metrics.REGISTRY.collector
+def collect_app_metrics():
+    caches = {'enrollment': {'hit': enrollmentCache.hits,
+                             'stale_hit': enrollmentCache.stale_hits,
+                             'miss': enrollmentCache.misses},
+              'lookup': {'hit': courseLookups.hits,
+                         'negative_hit': courseLookups.negative_hits,
+                         'miss': courseLookups.misses},
+              'render': {'hit': renderCache.hits,
+                         'miss': renderCache.misses},
+              'offering': {'hit': offeringIndex.hits,
+                           'miss': offeringIndex.misses}}
+    for name, counts in caches.items():
+        for result, count in counts.items():
+            cacheRequests.set(count, cache=name, result=result)
+        total = sum(counts.values())
+        cacheHitRatio.set(float(total - counts['miss']) / total if total else 0,
+                          cache=name)
+    for status, count in mailOutbox.counts().items():
+        outboxMessages.set(count, status=status)
+    breakerOpen.set(1 if valenceClient.breaker.is_open else 0)
+
+
+@app.before_request
+def start_timer():
+    g.requestStart = time.time()
+    requestsInFlight.inc()
+
+
+@app.after_request
+def count_response(response):
+    requestStatus.inc(endpoint=request.endpoint or 'unmatched',
+                      status=response.status_code)
+    return response
+
+
+@app.teardown_request
+def stop_timer(exc):
+    start = getattr(g, 'requestStart', None)
+    if start is not None:
+        requestSeconds.observe(time.time() - start,
+                               endpoint=request.endpoint or 'unmatched')
+        requestsInFlight.dec()
+
 
 
 ############
@@ -42,6 +323,18 @@ def login_required(test):
     return wrap
 
 
+def admin_required(test):
+    # checked against the D2L Identifier from whoami, which the user cannot
+    # choose, rather than the username
+    @wraps(test)
+    def wrap(*args, **kwargs):
+        admins = [str(userId) for userId in app.config.get('ADMIN_USERS', ())]
+        if 'userId' in session and str(session['userId']) in admins:
+            return test(*args, **kwargs)
+        abort(403)
+    return wrap
+
+
 ##########
 # routes #
 ##########
@@ -53,6 +346,7 @@ def logout():
     '''
     Clears stored session information.
     '''
+    userContexts.invalidate(session_key())
     session.clear()
     return redirect(app.config['REDIRECT_AFTER_LOGOUT'])
 
@@ -84,28 +378,35 @@ def auth_handler():
         result_uri=request.url, 
         host=app.config['LMS_HOST'],
         encrypt_requests=app.config['ENCRYPT_REQUESTS'])
-    my_url = uc.create_authenticated_url(
-        '/d2l/api/lp/{0}/users/whoami'.format(app.config['VER']))
-    r = requests.get(my_url)
+    whoami = valenceWorkers.whoami(uc).result()
 
-    session['firstName'] = r.json()['FirstName']
-    session['lastName'] = r.json()['LastName']
-    session['userId'] = r.json()['Identifier']
+    # a new session id for the signed-in user, whatever id the browser
+    # arrived with
+    userContexts.invalidate(session_key())
+    regenerate_session()
 
-    print("WHOAMI", r.json())
+    session['firstName'] = whoami['FirstName']
+    session['lastName'] = whoami['LastName']
+    session['userId'] = whoami['Identifier']
+
+    app.logger.debug('Signed in D2L user %s', session['userId'])
 
     """PRODUCTION: UNCOMMENT FOLLOWING LINE AND DELETE THE ONE AFTER THAT"""
-    #session['uniqueName'] = r.json()['UniqueName']
+    #session['uniqueName'] = whoami['UniqueName']
     session['uniqueName'] = 'lookerb'
 
     # feed in service account ID and key and store user context
     uc.user_id = app.config['USER_ID']
     uc.user_key = app.config['USER_KEY']
     session['userContext'] = uc.get_context_properties()
-
-    # get the dictionary of user's enrollments
-    if 'courseDict' not in session:
-        session['courseDict'] = get_courses(uc)
+    userContexts.invalidate(session_key())
+
+    # start fetching the user's enrollments while they pick a semester
+    if 'courseIndex' not in session:
+        userId = session['userId']
+        enrollmentPrefetch.start(userId,
+            lambda: enrollmentCache.get_or_load(userId,
+                lambda: get_courses(uc, userId)))
     return redirect(url_for('select_semester'))
 
 
@@ -127,8 +428,12 @@ def select_semester():
             session['semCode'] = semCode
 
             try:
-                courseDict = session['courseDict'][semCode]
-            except KeyError:
+                courses = get_course_index(
+                    timeout=app.config.get('PREFETCH_WAIT', 5)).semester(semCode)
+            except TimeoutError:
+                return render_template("semester.html", form=form,
+                    error=error, pending=True)
+            if not courses:
                 error = "No courses are listed with you enrolled" + \
                     "as an instructor for the selected semester."
                 return render_template("semester.html", form=form, error=error)
@@ -137,6 +442,16 @@ def select_semester():
         return render_template("semester.html", form=form, error=error)
 
 
+@app.route('/semester/status')
+@login_required
+def prefetch_status():
+    '''
+    Reports whether the user's enrollments are still being fetched.
+    '''
+    return jsonify(pending='courseIndex' not in session and
+        enrollmentPrefetch.running(session['userId']))
+
+
 @app.route('/enrollments', methods=['GET', 'POST'])
 @login_required
 def enrollment_handler():
@@ -145,52 +460,135 @@ def enrollment_handler():
     courses to that list. 
     '''
     error = None
-    uc = appContext.create_user_context(
-        d2l_user_context_props_dict=session['userContext'])
-    courseDict = session['courseDict'][session['semCode']]
+    uc = get_user_context()
+    courseIndex = get_course_index()
     form = SelectCoursesForm(request.form, prefix="form")
-    form.courseIds.choices = get_courseId_choices(courseDict)
-    form.baseCourse.choices = get_baseCourse_choices(courseDict)
+    set_course_choices(form, courseIndex, session['semCode'])
     add_form = AdditionalCourseForm(request.form, prefix="add_form")
+    bulk_form = BulkCourseForm(request.form, prefix="bulk_form")
     if request.method == 'POST':
         if form.is_submitted():
             if request.form['btn'] == 'Add Class' and add_form.validate_on_submit():
-                code = make_code(add_form)
+                code = make_code(session['semCode'],
+                    add_form.sessionLength.data,
+                    add_form.subject.data,
+                    add_form.catalogNumber.data,
+                    add_form.section.data,
+                    add_form.classNumber.data)
                 courseToAdd = get_course(uc, code)
                 if not courseToAdd:
                     error = "Please check course details and try again."
-                    return render_template("enrollments.html", form=form, add_form=add_form, error=error)
-                session['courseDict'][session['semCode']] = update_course_dict(courseDict,
+                    return render_template("enrollments.html", form=form, add_form=add_form, bulk_form=bulk_form, error=error)
+                courseIndex.add(session['semCode'],
                     courseToAdd['Identifier'],
                     courseToAdd['Name'],
                     code)
+                session['courseIndex'] = courseIndex.to_data()
+                enrollmentCache.invalidate(session['userId'])
                 return redirect(url_for('enrollment_handler'))
             elif request.form['btn'] == 'Add Class':
                 error = add_form.errors.values()[0][0]
-                return render_template("enrollments.html", form=form, add_form=add_form, error=error)
+                return render_template("enrollments.html", form=form, add_form=add_form, bulk_form=bulk_form, error=error)
+            elif request.form['btn'] == 'Add Classes' and bulk_form.validate_on_submit():
+                rows, rowErrors = parse_class_rows(bulk_form.classes.data)
+                # each row is a lookup in D2L
+                maxRows = app.config.get('BULK_ADD_MAX_ROWS', 30)
+                if len(rows) > maxRows:
+                    error = "Please add at most {0} classes at a time.".format(maxRows)
+                    return render_template("enrollments.html", form=form, add_form=add_form, bulk_form=bulk_form, error=error)
+                for row in rows:
+                    row['code'] = make_code(session['semCode'],
+                        bulk_form.sessionLength.data,
+                        row['subject'],
+                        row['catalogNumber'],
+                        row['section'],
+                        row['classNumber'])
+                    row['future'] = lookup_course(uc, row['code'])
+                # every lookup is finished before any class is added, so an
+                # unreachable D2L shows the unavailable page and adds nothing
+                for row in rows:
+                    try:
+                        row['course'] = row['future'].result()
+                    except (requests.ConnectionError, requests.Timeout):
+                        raise
+                    except Exception:
+                        app.logger.warning('Class lookup failed for %s', row['code'], exc_info=True)
+                        row['course'] = None
+                added = 0
+                for row in rows:
+                    courseToAdd = row['course']
+                    if not courseToAdd:
+                        rowErrors.append((row['line'], row['text'],
+                            "Please check course details and try again."))
+                        continue
+                    courseIndex.add(session['semCode'],
+                        courseToAdd['Identifier'],
+                        courseToAdd['Name'],
+                        row['code'])
+                    added += 1
+                if added:
+                    session['courseIndex'] = courseIndex.to_data()
+                    enrollmentCache.invalidate(session['userId'])
+                if rowErrors:
+                    rowErrors.sort()
+                    set_course_choices(form, courseIndex, session['semCode'])
+                    bulk_form.classes.data = "\n".join(text for line, text, message in rowErrors)
+                    error = "{0} of {1} classes could not be added.".format(
+                        len(rowErrors), len(rowErrors) + added)
+                    return render_template("enrollments.html", form=form, add_form=add_form,
+                        bulk_form=bulk_form, error=error, rowErrors=rowErrors)
+                return redirect(url_for('enrollment_handler'))
+            elif request.form['btn'] == 'Add Classes':
+                error = list(bulk_form.errors.values())[0][0]
+                return render_template("enrollments.html", form=form, add_form=add_form, bulk_form=bulk_form, error=error)
             elif request.form['btn'] == 'Submit Request':
-                courseIds = form.courseIds.data
-                coursesToCombine = [course for course in courseDict if course['courseId'] in courseIds]
-                baseCourse = {}
-                if form.baseCourse.data != 'None':
-                    update_base_course(baseCourse, form.baseCourse.data, courseDict)
-                else:
+                # only the selected semester's courses, whatever was posted
+                semCode = session['semCode']
+                coursesToCombine = [course for course in
+                    (courseIndex.get(courseId, semCode) for courseId in form.courseIds.data or ())
+                    if course is not None]
+                baseCourse = None
+                if form.baseCourse.data not in (None, 'None'):
+                    baseCourse = courseIndex.get(form.baseCourse.data, semCode)
+                if baseCourse is None:
                     error = 'You must select a base course into which to combine the courses.'
-                    return render_template("enrollments.html", form=form, add_form=add_form, error=error)
+                    return render_template("enrollments.html", form=form, add_form=add_form, bulk_form=bulk_form, error=error)
                 if len(coursesToCombine) == 0 or (len(coursesToCombine) == 1 and baseCourse in coursesToCombine):    
                     error = 'You must select at least two courses to combine.'
-                    return render_template("enrollments.html", form=form, add_form=add_form, error=error)
-                session['baseCourse'], session['coursesToCombine'] = baseCourse, coursesToCombine
-                if baseCourse not in coursesToCombine:
+                    return render_template("enrollments.html", form=form, add_form=add_form, bulk_form=bulk_form, error=error)
+                baseIncluded = baseCourse in coursesToCombine
+                if not baseIncluded:
                     coursesToCombine.append(baseCourse)
+                session['baseCourse'] = baseCourse.to_dict()
+                session['coursesToCombine'] = [course.to_dict() for course in coursesToCombine]
+                if not baseIncluded:
                     return render_template("check.html", coursesToCombine=coursesToCombine, baseCourse=baseCourse)
                 else:
                     return redirect(url_for('confirm_selections'))
         else:
             error = 'The form must be invalid for some reason...'
-            return render_template("enrollments.html", form=form, add_form=add_form, error=error)
+            return render_template("enrollments.html", form=form, add_form=add_form, bulk_form=bulk_form, error=error)
     else:
-        return render_template("enrollments.html", form=form, add_form=add_form, error=error)
+        return render_template("enrollments.html", form=form, add_form=add_form, bulk_form=bulk_form, error=error)
+
+
+@app.route('/offerings')
+@login_required
+def search_offerings():
+    '''
+    Typeahead for the add class form: the selected semester's offerings
+    matching ?q=, from the local index. Reports pending while the semester
+    is first being loaded from D2L, and unavailable if that failed.
+    '''
+    if 'semCode' not in session:
+        abort(400)
+    results = offeringIndex.search(session['semCode'], request.args.get('q', ''),
+        limit=app.config.get('OFFERING_SEARCH_LIMIT', 15))
+    if results is None:
+        failed = offeringIndex.failed(session['semCode'])
+        return jsonify(pending=not failed, unavailable=failed, results=[])
+    return jsonify(pending=False, unavailable=False,
+                   results=[o.to_dict() for o in results])
 
 
 @app.route('/confirmation')
@@ -199,19 +597,74 @@ def confirm_selections():
     '''
     Generates confirmation page and sends confirmation emails.
     '''
-    msg = Message(subject='Course Combine Confirmation',
-        recipients=[app.config['MAIL_DEFAULT_SENDER'],
-        session['uniqueName'] + "@" + app.config['EMAIL_DOMAIN']])
-    msg.body = generate_msg_text(session['firstName'],
-        session['lastName'],
-        session['coursesToCombine'],
-        session['baseCourse'])
-    msg.html = generate_msg_html(session['firstName'],
-        session['lastName'],
-        session['coursesToCombine'],
-        session['baseCourse'])
-    mail.send(msg)
-    return render_template("confirmation.html", coursesToCombine=session['coursesToCombine'], baseCourse=session['baseCourse'])
+    combine = {'firstName': session['firstName'],
+               'lastName': session['lastName'],
+               'email': session['uniqueName'] + "@" + app.config['EMAIL_DOMAIN'],
+               'semCode': session['semCode'],
+               'baseCourse': session['baseCourse'],
+               'coursesToCombine': session['coursesToCombine']}
+
+    # a refresh or second click finds the request already recorded and
+    # does not mail it again
+    requestId, created = ledger.record(session['userId'],
+        session['uniqueName'], combine['firstName'], combine['lastName'],
+        combine['semCode'], combine['baseCourse'], combine['coursesToCombine'])
+    if created:
+        try:
+            send_combine_mail(combine)
+        except Exception:
+            ledger.forget(requestId)
+            raise
+    return render_template("confirmation.html", coursesToCombine=session['coursesToCombine'], baseCourse=session['baseCourse'], created=created)
+
+
+@app.route('/admin/requests.<fmt>')
+@login_required
+@admin_required
+def export_requests(fmt):
+    '''
+    Streams combine requests as CSV or NDJSON, optionally filtered by
+    ?semester=<semester code>, ?status= and ?baseCourse=<courseId>.
+    '''
+    if fmt not in export.FORMATS:
+        abort(404)
+    semCode = request.args.get('semester') or None
+    if semCode is not None and not (semCode.isdigit() and len(semCode) == 4):
+        abort(400)
+    baseCourseId = request.args.get('baseCourse', type=int)
+    chunks = export.iter_export(ledger, fmt, semCode=semCode,
+        status=request.args.get('status') or None, baseCourseId=baseCourseId)
+    filename = 'combine-requests{0}.{1}'.format(
+        '-' + semCode if semCode else '', fmt)
+    return Response(chunks, mimetype=export.MIMETYPES[fmt], headers={
+        'Content-Disposition': 'attachment; filename=' + filename})
+
+
+@app.errorhandler(requests.ConnectionError)
+@app.errorhandler(requests.Timeout)
+def valence_unavailable(e):
+    '''
+    Shown when D2L cannot be reached, or while calls to it are failing fast.
+    '''
+    app.logger.warning('D2L unavailable: %s', e)
+    return render_template('unavailable.html'), 503
+
+
+@app.route('/metrics')
+def metrics_handler():
+    '''
+    Prometheus text exposition of every worker's metrics when they are
+    published to METRICS_SQLITE_PATH, and otherwise of this process's.
+    Only served to a scraper sending METRICS_TOKEN as a bearer token.
+    '''
+    if not metrics_authorized(request.headers.get('Authorization', '')):
+        abort(404)
+    if metricsStore is None:
+        text = metrics.REGISTRY.render()
+    else:
+        publish_metrics(force=True)
+        text = metrics.REGISTRY.render(metricsStore.items())
+    return Response(text, mimetype='text/plain; version=0.0.4')
 
 
 ###########
@@ -219,37 +672,64 @@ def confirm_selections():
 ###########
 
 
-def generate_msg_text(firstName, lastName, coursesToCombine, baseCourse):
+def metrics_authorized(authorization):
+    '''
+    True if the Authorization header carries METRICS_TOKEN as a bearer
+    token. Always False while no token is configured.
+    '''
+    token = app.config.get('METRICS_TOKEN')
+    scheme, _, credentials = authorization.partition(' ')
+    if not token or scheme.lower() != 'bearer':
+        return False
+    return hmac.compare_digest(credentials.strip().encode('utf-8'),
+                               token.encode('utf-8'))
+
+
+def render_email(name, **context):
+    '''
+    Renders templates/email/<name>.txt and .html, returning (body, html).
+    '''
+    return (render_template('email/{0}.txt'.format(name), **context),
+            render_template('email/{0}.html'.format(name), **context))
+
+
+def send_combine_mail(combine):
+    '''
+    Confirms a combine request to the instructor right away and passes it
+    on to the site administrator, on its own or in the next digest.
     '''
-    Generates confirmation email message text.
-    ''' 
-    greeting = "Hello {0} {1},\n".format(firstName, lastName)
-    opening = "You have asked to have the following courses combined into " + \
-        "{0}, {1}:\n\nCourse Name\t(Course Id)\n".format(baseCourse['parsed'],
-        baseCourse['name'])
-    courseTable = "\n".join("{!s}\t({!s})".format(course['name'],
-        course['code']) for course in coursesToCombine)
-    closing = "\nIf this is incorrect, please contact our D2L site" + \
-        "administrator at " + app.config['EMAIL_SITE_ADMIN'] + "."
-    msg_body = greeting + opening + courseTable + closing
-    return msg_body
+    msg = Message(subject='Course Combine Confirmation',
+        recipients=[combine['email']])
+    msg.body, msg.html = render_email('confirmation', **combine)
+    mailOutbox.enqueue(msg)
+
+    if adminDigest is not None:
+        adminDigest.add(combine)
+    else:
+        msg = Message(subject='Course Combine Request',
+            recipients=[app.config['MAIL_DEFAULT_SENDER']])
+        msg.body, msg.html = render_email('request', **combine)
+        mailOutbox.enqueue(msg)
 
 
-def generate_msg_html(firstName, lastName, coursesToCombine, baseCourse):
+def build_digest(items):
     '''
-    Generates confirmation email message in HTML.
+    Builds the site administrator's digest message from held combine
+    requests, grouped by semester and then by base course.
     '''
-    greeting = "<p>Hello {0} {1},</p><p>".format(firstName, lastName)
-    opening = "You have asked to have the following courses combined into " +\
-        " {0}, {1}:</p>".format(baseCourse['parsed'], baseCourse['name'])
-    tableHead = "<table><thead><tr><th>Course Name</th><th>(Course Id)</th></thead>"
-    courseTable = "".join("<tr><td>{!s}</td><td>({!s})</td></tr>".format(
-        course['name'], course['code']) for course in coursesToCombine)
-    tableClose = "</table>"
-    closing = "<p>If this is incorrect, please contact our D2L site" + \
-        "administrator at " + app.config['EMAIL_SITE_ADMIN'] + ".</p>"
-    msg_html = greeting + opening + tableHead + courseTable + tableClose + closing
-    return msg_html
+    semesters = []
+    for item in sorted(items, key=lambda i: (i['semCode'], i['baseCourse']['code'])):
+        if not semesters or semesters[-1][0] != item['semCode']:
+            semesters.append((item['semCode'], []))
+        bases = semesters[-1][1]
+        if not bases or bases[-1][0]['code'] != item['baseCourse']['code']:
+            bases.append((item['baseCourse'], []))
+        bases[-1][1].append(item)
+    msg = Message(subject='Course Combine Requests ({0})'.format(len(items)),
+        recipients=[app.config['MAIL_DEFAULT_SENDER']])
+    msg.body, msg.html = render_email('digest', count=len(items),
+                                      semesters=semesters)
+    return msg
 
 
 def get_semester(semester, year):
@@ -271,129 +751,206 @@ def get_semester(semester, year):
     return semesterCode
 
 
-def get_courses(uc):
+def get_courses(uc, userId):
     '''
-    Creates dictionary of lists of courses keyed by semester code and stores 
-    it in session for easy access post-creation.
+    Creates the index of the user's instructor enrollments, grouped by
+    semester code, in the serialized form kept in the session and cache.
+    The pages are fetched on the Valence pool.
     '''
-    myUrl = uc.create_authenticated_url(
-        '/d2l/api/lp/{0}/enrollments/users/{1}/orgUnits/'.format(
-        app.config['VER'], session['userId']))
-    kwargs = {'params': {}}
-    kwargs['params'].update({'roleId':app.config['ROLE_ID']})
-    kwargs['params'].update({'orgUnitTypeId': app.config['ORG_UNIT_TYPE_ID']})
-    r = requests.get(myUrl, **kwargs)
+    return valenceWorkers.enrollments(uc, userId, build_course_index,
+        roleId=app.config['ROLE_ID'],
+        orgUnitTypeId=app.config['ORG_UNIT_TYPE_ID']).result()
 
-    print("REASON", r.reason)
 
+def build_course_index(pages):
+    '''
+    Builds the serialized CourseIndex from pages of enrollment records.
+    '''
+    courseIndex = CourseIndex()
+    # parse and index each page as it arrives rather than holding every
+    # enrollment of a long-serving instructor at once
+    for courses in pages:
+        codes = parse_codes([course['Code'] for course in courses])
+        for course, code in zip(courses, codes):
+            # codes outside the UWOSH pattern are not course offerings that
+            # can be combined, e.g. sandboxes and templates
+            if code is not None:
+                courseIndex.add(code.semCode, course['Id'], course['Name'],
+                                code.code, code.short)
+    return courseIndex.to_data()
 
-    courseDict = {}
-    end = False
-    while end == False:
-        for course in r.json()['Items']:
-            semCode = str(course['OrgUnit']['Code'][6:10])
-            if semCode.isdigit():
-                if semCode not in courseDict:
-                    courseDict[semCode] = []
-                courseDict[semCode] = update_course_dict(courseDict[semCode],
-                    course['OrgUnit']['Id'],
-                    course['OrgUnit']['Name'],
-                    course['OrgUnit']['Code'])
 
-            if r.json()['PagingInfo']['HasMoreItems'] == True:
-                kwargs['params']['bookmark'] = r.json()['PagingInfo']['Bookmark']
-                r = requests.get(myUrl, **kwargs)
-        else:
-            end = True
-    return courseDict
+def regenerate_session():
+    '''
+    Gives a server-side session a new id. Cookie sessions hold no id.
+    '''
+    if sessionInterface is not None:
+        sessionInterface.regenerate(session)
 
 
-def update_course_dict(courseDict, courseId, name, code):
+def session_key():
     '''
-    Adds a course's info to the courseDict.
+    Identifies the current session for per-session caches.
     '''
-    courseDict.append({u'courseId': int(courseId),
-        u'name': name,
-        u'code': code,
-        u'parsed': parse_code(code)})
-    return courseDict
+    return getattr(session, 'sid', None) or session.get('userId')
+
+
+def get_user_context():
+    '''
+    Returns the live user context for the session's stored context
+    properties, reusing the one built on an earlier request when possible.
+    '''
+    return userContexts.get(session_key(), session['userContext'])
+
+
+def get_course_index(timeout=None):
+    '''
+    Returns the user's CourseIndex, collecting it from the background fetch
+    started at login the first time it is needed, or from one started now
+    if this process did not start it. Raises
+    concurrent.futures.TimeoutError if the fetch is still running after
+    timeout seconds.
+    '''
+    if 'courseIndex' not in session:
+        userId = session['userId']
+        uc = get_user_context()
+        session['courseIndex'] = enrollmentPrefetch.result(userId,
+            lambda: enrollmentCache.get_or_load(userId,
+                lambda: get_courses(uc, userId)),
+            timeout=timeout)
+    return CourseIndex.from_data(session['courseIndex'])
 
 
 def get_course(uc, code):
     '''
-    Gets course information for supplied code from D2L.
+    Gets course information for supplied code from the semester's offering
+    index, or else from D2L or the lookups other users have already made
+    for it.
     '''
-    myUrl = uc.create_authenticated_url('/d2l/api/lp/{0}/orgstructure/'.format(app.config['VER']))
-    kwargs = {'params': {}}
-    kwargs['params'].update({'orgUnitCode': code})
-    kwargs['params'].update({'orgUnitType': app.config['ORG_UNIT_TYPE_ID']})
-    r = requests.get(myUrl, **kwargs)
-    try:
-        return r.json()['Items'][0]
-    except IndexError:
-        return False
+    return lookup_course(uc, code).result()
 
 
-def parse_code(code):
+def lookup_course(uc, code):
     '''
-    Breaks up code into more readable version to present to user.
+    Future of get_course(uc, code), already done when the offering index or
+    an earlier lookup has the code and otherwise looked up in D2L on the
+    Valence pool.
     '''
-    parsed = code.split("_")
-    return parsed[3] + " " + parsed[4] + " " + parsed[5]
+    parsed = parse_course_code(code)
+    if parsed is not None:
+        offering = offeringIndex.find(parsed.semCode, code)
+        if offering is not None:
+            return done_future(offering.to_org_unit())
+    orgUnitType = app.config['ORG_UNIT_TYPE_ID']
+    orgUnit = courseLookups.get(code, orgUnitType)
+    if orgUnit is not None:
+        return done_future(orgUnit)
+
+    def remember(future):
+        if future.exception() is None:
+            courseLookups.set(code, orgUnitType, future.result())
+
+    future = valenceWorkers.orgstructure(uc, code, orgUnitType)
+    future.add_done_callback(remember)
+    return future
 
 
-def get_courseId_choices(courseDict):
+def done_future(value):
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+def service_context():
     '''
-    Pulls elements from courseDict to use in form choices.
+    User context for the app's service account (USER_ID/USER_KEY).
     '''
-    return [(course['courseId'], 
-        course['name'] + ", " + course['parsed']) for course in courseDict]
+    return appContext.create_user_context(d2l_user_context_props_dict={
+        'host': app.config['LMS_HOST'],
+        'user_id': app.config['USER_ID'],
+        'user_key': app.config['USER_KEY'],
+        'encrypt_requests': app.config['ENCRYPT_REQUESTS'],
+        'server_skew': 0})
 
 
-def get_baseCourse_choices(courseDict):
+def load_offerings(semCode):
     '''
-    Pulls elements from courseDict to use in baseCourse choices, with markup to
-    make choices linkable.
+    Lists a semester's course offerings from D2L with the service account.
+    '''
+    return valence.iter_org_units(valenceClient, service_context(),
+        app.config['VER'],
+        orgUnitType=app.config['ORG_UNIT_TYPE_ID'],
+        orgUnitCode=code_filter(semCode))
+
+
+def get_courseId_choices(courses):
+    '''
+    Pulls elements from a semester's courses to use in form choices.
+    '''
+    return [(course.courseId, 
+        course.name + ", " + course.parsed) for course in courses]
+
+
+def get_baseCourse_choices(courses):
+    '''
+    Pulls elements from a semester's courses to use in baseCourse choices, with
+    markup to make choices linkable.
     '''
     linkPrefix = "<a target=\"_blank\" href='http://" + \
         app.config['LMS_HOST'] + \
         "/d2l/lp/manageCourses/course_offering_info_viewedit.d2l?ou="
 
-    return [(course['courseId'],
+    return [(course.courseId,
         linkPrefix +
-        str(course['courseId']) +
+        str(course.courseId) +
         "'>" +
-        course['name'] +
+        course.name +
         ", " +
-        course['parsed'] +
-        "</a>") for course in courseDict]
+        course.parsed +
+        "</a>") for course in courses]
+
+
+def set_course_choices(form, courseIndex, semCode):
+    '''
+    Sets the course choices on a SelectCoursesForm, building them only once
+    per state of the semester's course list.
+    '''
+    form.cacheKey = (courseIndex.stamp, semCode, courseIndex.version)
+    choices = renderCache.get(('choices',) + form.cacheKey)
+    if choices is None:
+        courses = courseIndex.semester(semCode)
+        choices = (get_courseId_choices(courses), get_baseCourse_choices(courses))
+        renderCache.set(('choices',) + form.cacheKey, choices)
+    form.courseIds.choices, form.baseCourse.choices = choices
 
 
-def make_code(add_form):
+def cached_field(form, field):
     '''
-    Creates code from the elements submitted in add form.
+    Renders a course field of a SelectCoursesForm, reusing the markup from an
+    earlier render of the same choices and selection.
     '''
-    return '_'.join(('UWOSH',
-        session['semCode'],
-        add_form.sessionLength.data,
-        add_form.subject.data,
-        add_form.catalogNumber.data,
-        'SEC' + add_form.section.data,
-        add_form.classNumber.data))
+    data = field.data
+    if isinstance(data, list):
+        data = tuple(data)
+    key = ('field', field.name, data) + form.cacheKey
+    html = renderCache.get(key)
+    if html is None:
+        html = Markup(field())
+        renderCache.set(key, html)
+    return html
 
 
-def update_base_course(baseCourse, baseCourseData, courseDict):
+def precompile_templates():
     '''
-    Populates baseCourse dictionary with user-selected baseCourse data.
+    Loads every template so the first requests a worker serves do not pay
+    for compiling them.
     '''
-    baseCourseId = int(baseCourseData)
-    for course in courseDict:
-        if course['courseId'] == baseCourseId:
-            baseCourse.update(course)
+    for name in app.jinja_env.list_templates(extensions=['html', 'txt']):
+        app.jinja_env.get_template(name)
 
 
-app.jinja_env.globals.update(parse_code=parse_code)
+app.jinja_env.globals.update(parse_code=parse_code, cached_field=cached_field)
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app(debug=True).run(debug=True)
@@ -0,0 +1,121 @@
+# enrollments/warmup.py
+#
+# Fetches instructors' course lists with the service account ahead of their
+# logins, into the enrollment cache shared by the app's workers. Run it from
+# cron in the first weeks of term:
+#
+#     python warmup.py --org-unit 6606
+#     python warmup.py --users instructors.txt --workers 4 --rate 5
+#     python warmup.py 1234 5678
+
+import argparse
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+###########
+# warm-up #
+###########
+
+
+class RateLimiter(object):
+    '''
+    Spaces calls from any number of threads at least 1/rate seconds apart.
+    A rate of 0 does not limit.
+    '''
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def warm_up(userIds, load, cache, workers=4, rate=5.0, force=False, log=None):
+    '''
+    Caches load(userId) for each user id, at most `workers` at a time and
+    `rate` users a second. Users whose cached list is still fresh are skipped
+    unless force is set. Returns counts of users warmed, skipped and failed.
+    '''
+    limiter = RateLimiter(rate)
+
+    def warm(userId):
+        if not force and cache.fresh(userId):
+            return 'skipped'
+        limiter.wait()
+        try:
+            cache.set(userId, load(userId))
+        except Exception as e:
+            if log is not None:
+                log.write('{0}: {1!r}\n'.format(userId, e))
+            return 'failed'
+        return 'warmed'
+
+    counts = {'warmed': 0, 'skipped': 0, 'failed': 0}
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for result in executor.map(warm, userIds):
+            counts[result] += 1
+    finally:
+        executor.shutdown()
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Cache instructors' course lists ahead of their logins.")
+    parser.add_argument('userIds', nargs='*', metavar='userId',
+                        help='D2L user Identifier')
+    parser.add_argument('--users', help='file of user Identifiers, one a line')
+    parser.add_argument('--org-unit', type=int, action='append', default=[],
+                        help='warm every instructor enrolled in this org unit '
+                        '(e.g. a semester); may be repeated')
+    parser.add_argument('--workers', type=int,
+                        help='users fetched at once (default: WARM_UP_WORKERS)')
+    parser.add_argument('--rate', type=float,
+                        help='users started per second (default: WARM_UP_RATE)')
+    parser.add_argument('--force', action='store_true',
+                        help='refetch users whose cached list is still fresh')
+    args = parser.parse_args(argv)
+
+    import views
+    import valence
+    app = views.app
+    if views.enrollmentStore is None:
+        parser.error('set ENROLLMENT_CACHE_SQLITE_PATH so the app workers '
+                     'can see what this job caches')
+    uc = views.service_context()
+
+    userIds = list(args.userIds)
+    if args.users:
+        with open(args.users) as f:
+            userIds.extend(line.strip() for line in f if line.strip())
+    for orgUnitId in args.org_unit:
+        userIds.extend(valence.iter_org_unit_users(views.valenceClient, uc,
+            app.config['VER'], orgUnitId, roleId=app.config['ROLE_ID']))
+    seen = set()
+    userIds = [u for u in userIds if not (u in seen or seen.add(u))]
+
+    started = time.time()
+    counts = warm_up(userIds, lambda userId: views.get_courses(uc, userId),
+        views.enrollmentCache,
+        workers=args.workers or app.config.get('WARM_UP_WORKERS', 4),
+        rate=app.config.get('WARM_UP_RATE', 5.0) if args.rate is None else args.rate,
+        force=args.force, log=sys.stderr)
+    print('{0} users: {1[warmed]} warmed, {1[skipped]} still fresh, '
+          '{1[failed]} failed in {2:.1f}s'.format(len(userIds), counts,
+                                                  time.time() - started))
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,8 @@
+# wsgi.py
+#
+# WSGI entry point for production servers, e.g.
+#
+#     gunicorn -c gunicorn.conf.py wsgi:application
+
+from views import create_app
+application = create_app()